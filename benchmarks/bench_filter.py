@@ -0,0 +1,114 @@
+"""Message rate per core of the frigate/events filter, before and after the compiled filter.
+
+Usage: python benchmarks/bench_filter.py [--stream events.jsonl] [--cameras front] [--labels person]
+
+--stream takes a recorded event stream, one raw frigate/events payload per line
+(for example from `mosquitto_sub -t frigate/events`). Without it a synthetic
+stream is generated: several cameras and labels, each object sending one new,
+a run of update and one end message.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mqtt-to-email'))
+
+from event_filter import EventFilter, loads, orjson  # noqa: E402
+
+CAMERAS = ['front', 'back', 'driveway', 'garage', 'side', 'porch']
+LABELS = ['person', 'car', 'cat', 'dog', 'bicycle']
+
+
+def synthetic_state(event_id, camera, label, score, frame_time):
+    return {
+        'id': event_id, 'camera': camera, 'frame_time': frame_time, 'snapshot_time': frame_time,
+        'label': label, 'sub_label': None, 'top_score': score, 'false_positive': False,
+        'start_time': frame_time - 2, 'end_time': None, 'score': score,
+        'box': [412, 180, 520, 460], 'area': 30240, 'ratio': 0.38, 'region': [300, 100, 620, 420],
+        'stationary': False, 'motionless_count': 0, 'position_changes': 2,
+        'current_zones': ['yard'], 'entered_zones': ['yard'], 'has_clip': True, 'has_snapshot': True,
+        'attributes': {}, 'current_attributes': [],
+        'path_data': [[[0.1 * i, 0.2 * i], frame_time - i] for i in range(10)],
+    }
+
+
+def synthetic_stream(objects=2000, updates=10, seed=1):
+    random.seed(seed)
+    payloads = []
+    for n in range(objects):
+        event_id = f"{1700000000 + n}.123456-{random.randrange(16 ** 6):06x}"
+        camera, label = random.choice(CAMERAS), random.choice(LABELS)
+        before = synthetic_state(event_id, camera, label, 0.6, 1700000000.0 + n)
+        for kind in ['new'] + ['update'] * updates + ['end']:
+            after = synthetic_state(event_id, camera, label, min(0.99, before['score'] + 0.03), before['frame_time'] + 0.2)
+            payloads.append(json.dumps({'type': kind, 'before': before, 'after': after}).encode())
+            before = after
+    return payloads
+
+
+def baseline(payloads, cameras, labels):
+    """The original on_message path: decode, format for the debug log, then filter."""
+    accepted = 0
+    for raw in payloads:
+        payload = json.loads(raw.decode('utf-8'))
+        camera_name = payload['after']['camera']
+        event_label = payload['after']['label']
+        f"Received message: {payload}"
+        if 'ALL' not in cameras and camera_name not in cameras:
+            continue
+        if event_label not in labels:
+            continue
+        accepted += 1
+    return accepted
+
+
+def compiled(payloads, event_filter):
+    accepted = 0
+    for raw in payloads:
+        if event_filter.quick_reject(raw):
+            continue
+        if event_filter.reject_reason(loads(raw)) is None:
+            accepted += 1
+    return accepted
+
+
+def measure(name, func, payloads, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        accepted = func()
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<34} {len(payloads) / best:>12,.0f} msg/s per core   ({accepted} accepted)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stream', help='recorded frigate/events payloads, one per line')
+    parser.add_argument('--cameras', default='front', help='comma-separated cameras, or ALL')
+    parser.add_argument('--labels', default='person', help='comma-separated labels')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as f:
+            payloads = [line.strip() for line in f if line.strip()]
+    else:
+        payloads = synthetic_stream()
+    cameras = args.cameras.split(',')
+    labels = args.labels.split(',')
+    event_filter = EventFilter(cameras, labels)
+
+    size = sum(len(p) for p in payloads) / len(payloads)
+    print(f"{len(payloads)} messages, {size:.0f} bytes on average, orjson {'installed' if orjson else 'not installed'}")
+    before = measure('before (json.loads + debug format)', lambda: baseline(payloads, cameras, labels), payloads, args.repeat)
+    after = measure('after (compiled filter)', lambda: compiled(payloads, event_filter), payloads, args.repeat)
+    print(f"speed-up: {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""End-to-end alert and clip latency of mqtt-to-email and email-listener against local stand-ins.
+
+Usage: python benchmarks/bench_pipeline.py [--events 200] [--rate 500] [--stream events.jsonl] [--clip-fraction 0.2]
+
+Frigate, the SMTP server and the IMAP server are replaced by the in-process fakes in
+fakes.py, so no network or credentials are needed. Frigate event messages are
+handed to Notifier.on_message in mqtt_to_email the way the MQTT network thread would, at
+--rate messages per second (0 replays as fast as possible). --stream takes a
+recorded event stream, one raw frigate/events payload per line; without it the
+synthetic stream from bench_filter.py is used.
+
+Once the alerts are delivered, a share of them get a signed clip request in the
+fake inbox, which email_listener.check_incoming_emails picks up over IDLE.
+
+Reported: replay throughput, p50/p99 alert and clip latency (from the first
+qualifying message, or the request email, to the message reaching the SMTP
+server), peak RSS, and duplicate and lost alert counts. --alert-mode best or early
+runs mqtt-to-email's lifecycle tracker; latency then includes the debounce, and
+early-mode follow-ups are counted on their own rather than as duplicates.
+"""
+import argparse
+import email.message
+import email.parser
+import email.policy
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'mqtt-to-email'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'email-listener'))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from bench_filter import synthetic_stream  # noqa: E402
+from fakes import FakeFrigate, FakeIMAP, SMTPSink  # noqa: E402
+
+EMAIL_ADDRESS = 'frigate@example.com'
+EMAIL_RECIPIENT = 'owner@example.com'
+SENT_FOLDER = '[Gmail]/Sent Mail'
+CLIP_TOKEN_SECRET = 'benchmark-secret'
+
+ALERT_PATTERN = re.compile(rb'snapshot for the event ID ([\w.-]+) from')
+CLIP_SUBJECT_PATTERN = re.compile(r'Frigate Clip: Event ([\w.-]+)')
+
+
+class Deliveries:
+    """Messages reaching the fake SMTP server, split into alerts and clips by event ID."""
+
+    def __init__(self, imap):
+        self.imap = imap
+        self.alerts = {}
+        self.clips = {}
+        self.followups = 0
+        self.other = 0
+        self._lock = threading.Lock()
+        self._parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+
+    def __call__(self, raw, received_at):
+        subject = str(self._parser.parsebytes(raw)['Subject'] or '')
+        clip = CLIP_SUBJECT_PATTERN.match(subject)
+        alert = None if clip else ALERT_PATTERN.search(raw)
+        with self._lock:
+            if clip:
+                self.clips.setdefault(clip.group(1), []).append(received_at)
+            elif alert and subject.endswith('(better snapshot)'):
+                self.followups += 1
+            elif alert:
+                self.alerts.setdefault(alert.group(1).decode(), []).append(received_at)
+            else:
+                self.other += 1
+        if clip:
+            # What Gmail does, so the listener has a sent copy to clean up
+            self.imap.add(raw, SENT_FOLDER)
+
+    def count(self, kind):
+        with self._lock:
+            return len(getattr(self, kind))
+
+
+def configure(frigate, sink, imap, workdir, args):
+    """Point both services at the fakes; must run before they are imported."""
+    os.environ.update({
+        'LOG_LEVEL': args.log_level,
+        'EMAIL_ADDRESS': EMAIL_ADDRESS,
+        'EMAIL_PASSWORD': 'password',
+        'EMAIL_RECIPIENT': EMAIL_RECIPIENT,
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(sink.port),
+        'SMTP_SECURITY': 'none',
+        'FRIGATE_HOST': '127.0.0.1',
+        'FRIGATE_PORT': str(frigate.port),
+        'IMAP_SERVER': '127.0.0.1',
+        'IMAP_PORT': str(imap.port),
+        'IMAP_SSL': 'false',
+        'IMAP_SENT_FOLDER': f'"{SENT_FOLDER}"',
+        'IMAP_STATE_FILE': os.path.join(workdir, 'email_listener_state.json'),
+        'SPOOL_DIR': os.path.join(workdir, 'spool-alerts'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media'),
+        'MEDIA_PREFETCH_CLIPS': 'true' if args.prefetch else 'false',
+        'MEDIA_PREFETCH_DELAY': '0',
+        'CLIP_TOKEN_SECRET': CLIP_TOKEN_SECRET,
+        'CLIP_OVERSIZE_STRATEGY': 'link',
+        'METRICS_PORT': '0',
+        'MQTT_TOPIC': 'frigate/events',
+    })
+    for name in ('WORKER_COUNT', 'QUEUE_SIZE', 'SMTP_POOL_SIZE', 'CLIP_WORKERS', 'ALERT_MODE', 'ALERT_DEBOUNCE'):
+        value = getattr(args, name.lower())
+        if value is not None:
+            os.environ[name] = str(value)
+
+
+def load_services(workdir):
+    import mqtt_to_email
+    notifier = mqtt_to_email.Notifier(mqtt_to_email.NotifierConfig.from_env()).start()
+    # Each service has its own spool, as it would in its own container; email-listener reads it at import
+    os.environ['SPOOL_DIR'] = os.path.join(workdir, 'spool-clips')
+    import email_listener
+    return mqtt_to_email, notifier, email_listener
+
+
+def expected_alerts(notifier, payloads):
+    """Index of the first message that should raise an alert, mapped to its event ID."""
+    from event_filter import loads
+    first = {}
+    seen = set()
+    for index, raw in enumerate(payloads):
+        payload = loads(raw)
+        event_id = payload['after']['id']
+        if event_id in seen or not payload['after'].get('has_snapshot'):
+            continue
+        if notifier.rules.match(payload):
+            seen.add(event_id)
+            first[index] = event_id
+    return first
+
+
+def replay(notifier, payloads, first, rate):
+    published = {}
+    started = time.perf_counter()
+    for index, raw in enumerate(payloads):
+        if rate:
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        msg = mqtt.MQTTMessage(topic=b'frigate/events')
+        msg.payload = raw
+        if index in first:
+            published[first[index]] = time.time()
+        notifier.on_message(None, None, msg)
+    return published, time.perf_counter() - started
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def latencies(sent, received):
+    return [received[key][0] - sent_at for key, sent_at in sent.items() if key in received]
+
+
+def report_latency(name, values):
+    if not values:
+        print(f"{name:<22} no deliveries")
+        return
+    values = sorted(values)
+    p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+    print(f"{name:<22} p50 {statistics.median(values) * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms   "
+          f"max {values[-1] * 1000:8.1f} ms")
+
+
+def request_email(event_id, subject):
+    msg = email.message.EmailMessage()
+    msg['From'] = EMAIL_RECIPIENT
+    msg['To'] = EMAIL_ADDRESS
+    msg['Subject'] = subject
+    msg.set_content(f"Please send the clip for the event ID {event_id}.")
+    return msg.as_bytes(policy=email.policy.SMTP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stream', help='recorded frigate/events payloads, one per line')
+    parser.add_argument('--events', type=int, default=200, help='objects in the synthetic stream')
+    parser.add_argument('--updates', type=int, default=10, help='update messages per synthetic object')
+    parser.add_argument('--rate', type=float, default=500, help='messages per second, 0 for as fast as possible')
+    parser.add_argument('--clip-fraction', type=float, default=0.2, help='share of alerts that get a clip request')
+    parser.add_argument('--prefetch', action='store_true', help='prefetch clips when events end')
+    parser.add_argument('--snapshot-bytes', type=int, default=60_000)
+    parser.add_argument('--clip-bytes', type=int, default=2_000_000)
+    parser.add_argument('--frigate-delay', type=float, default=0.0, help='seconds Frigate takes per request')
+    parser.add_argument('--smtp-delay', type=float, default=0.0, help='seconds the SMTP server takes per message')
+    parser.add_argument('--worker-count', type=int)
+    parser.add_argument('--queue-size', type=int)
+    parser.add_argument('--smtp-pool-size', type=int)
+    parser.add_argument('--clip-workers', type=int)
+    parser.add_argument('--alert-mode', choices=('first', 'best', 'early'), help="mqtt-to-email's ALERT_MODE")
+    parser.add_argument('--alert-debounce', type=float, help='seconds best mode waits after the first message')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for deliveries')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args()
+
+    frigate = FakeFrigate(args.snapshot_bytes, args.clip_bytes, args.frigate_delay)
+    imap = FakeIMAP()
+    deliveries = Deliveries(imap)
+    sink = SMTPSink(deliveries, args.smtp_delay)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(frigate, sink, imap, workdir, args)
+        mqtt_to_email, notifier, email_listener = load_services(workdir)
+        from common import clip_token
+
+        if args.stream:
+            with open(args.stream, 'rb') as f:
+                payloads = [line.strip() for line in f if line.strip()]
+        else:
+            payloads = synthetic_stream(args.events, args.updates)
+        first = expected_alerts(notifier, payloads)
+
+        email_listener.spool.start()
+        threading.Thread(target=email_listener.check_incoming_emails, name='email-listener', daemon=True).start()
+
+        print(f"{len(payloads)} messages, {len(first)} should alert, "
+              f"rate {'unlimited' if not args.rate else f'{args.rate:g}/s'}")
+        published, elapsed = replay(notifier, payloads, first, args.rate)
+        # Events dropped from a full queue will never arrive, so stop waiting for them
+        wait_for(lambda: deliveries.count('alerts') + mqtt_to_email.EVENTS_DROPPED.value() >= len(first), args.timeout)
+        # Anything sent twice tends to arrive right behind the first copy
+        time.sleep(0.5)
+        if notifier.tracker:
+            # Follow-ups are queued behind the alerts
+            wait_for(lambda: deliveries.followups >= notifier.tracker.stats()['followups'], args.timeout)
+
+        print(f"{'replay':<22} {len(payloads) / elapsed:10,.0f} msg/s   ({elapsed:.2f}s)")
+        if deliveries.alerts:
+            last = max(times[0] for times in deliveries.alerts.values())
+            print(f"{'alert throughput':<22} {len(deliveries.alerts) / max(last - min(published.values()), 1e-9):10,.1f} alerts/s")
+        report_latency('alert latency', latencies(published, deliveries.alerts))
+        duplicates = sum(len(times) - 1 for times in deliveries.alerts.values())
+        unexpected = len(set(deliveries.alerts) - set(published))
+        lost = len(set(published) - set(deliveries.alerts))
+        print(f"{'alerts':<22} {len(deliveries.alerts)} delivered, {duplicates} duplicate, {lost} lost, "
+              f"{unexpected} unexpected, {mqtt_to_email.EVENTS_DROPPED.value():.0f} dropped from a full queue")
+        if notifier.tracker:
+            print(f"{'follow-ups':<22} {deliveries.followups}")
+        frigate_alert_requests = frigate.requests
+
+        requested = {}
+        count = round(len(deliveries.alerts) * args.clip_fraction)
+        if count:
+            # Let the listener reach IDLE first, so the requests arrive as pushed updates
+            time.sleep(0.5)
+            for event_id in list(deliveries.alerts)[:count]:
+                requested[event_id] = time.time()
+                imap.add(request_email(event_id, clip_token.request_subject(event_id, CLIP_TOKEN_SECRET)))
+            wait_for(lambda: deliveries.count('clips') >= len(requested), args.timeout)
+            wait_for(lambda: imap.count(SENT_FOLDER) == 0 and imap.count() == 0, 5)
+            time.sleep(0.5)
+            report_latency('clip latency', latencies(requested, deliveries.clips))
+            duplicates = sum(len(times) - 1 for times in deliveries.clips.values())
+            lost = len(set(requested) - set(deliveries.clips))
+            print(f"{'clips':<22} {len(deliveries.clips)} delivered, {duplicates} duplicate, {lost} lost, "
+                  f"{imap.count()} request(s) and {imap.count(SENT_FOLDER)} sent copies left on the server")
+
+        print(f"{'frigate requests':<22} {frigate.requests} ({frigate_alert_requests} for the alerts)")
+        print(f"{'smtp sessions':<22} {sink.sessions}")
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+        print(f"{'peak RSS':<22} {peak_mb:10,.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
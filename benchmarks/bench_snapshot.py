@@ -0,0 +1,80 @@
+"""Bytes saved and encode cost of the local snapshot pipeline.
+
+Usage: python benchmarks/bench_snapshot.py [snapshot.jpg ...]
+
+Without arguments a synthetic 4K frame is used. Needs Pillow.
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mqtt-to-email'))
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+from snapshot import process_image  # noqa: E402
+
+CONFIGS = [
+    {'max_dimension': 1920, 'quality': 85},
+    {'max_dimension': 1280, 'quality': 75},
+    {'max_dimension': 640, 'quality': 70},
+    {'max_dimension': 1280, 'quality': 75, 'crop': True},
+]
+
+
+def synthetic_frame(width=3840, height=2160):
+    # Noise plus shapes, so the JPEG is about as hard to compress as a real camera frame
+    random.seed(1)
+    picture = Image.effect_noise((width, height), 40).convert('RGB')
+    draw = ImageDraw.Draw(picture)
+    for _ in range(200):
+        x, y = random.randrange(width), random.randrange(height)
+        colour = tuple(random.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + random.randrange(400), y + random.randrange(300)), fill=colour)
+    picture = picture.filter(ImageFilter.GaussianBlur(1))
+    output = io.BytesIO()
+    picture.save(output, format='JPEG', quality=95)
+    box = (width * 0.4, height * 0.3, width * 0.55, height * 0.8)
+    return output.getvalue(), box
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='*', help='JPEG snapshots to process')
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.images:
+        samples = []
+        for path in args.images:
+            with open(path, 'rb') as f:
+                image = f.read()
+            with Image.open(io.BytesIO(image)) as picture:
+                width, height = picture.size
+            samples.append((image, (width * 0.25, height * 0.25, width * 0.75, height * 0.75)))
+    else:
+        samples = [synthetic_frame()]
+
+    original = sum(len(image) for image, _ in samples) / len(samples)
+    print(f"{len(samples)} snapshot(s), {original / 1024:.0f} KiB on average")
+    print(f"{'config':<48} {'KiB out':>8} {'saved':>7} {'p50 ms':>8} {'max ms':>8}")
+    for config in CONFIGS:
+        sizes, timings = [], []
+        for image, box in samples:
+            for _ in range(args.iterations):
+                started = time.perf_counter()
+                processed = process_image(image, box, **config)
+                timings.append((time.perf_counter() - started) * 1000)
+                sizes.append(len(processed))
+        average = sum(sizes) / len(sizes)
+        label = ', '.join(f"{key}={value}" for key, value in config.items())
+        print(f"{label:<48} {average / 1024:>8.0f} {1 - average / original:>7.0%} "
+              f"{statistics.median(timings):>8.1f} {max(timings):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Concurrent event stream watchers and API clients against scheduler_web_server.
+
+Usage: python benchmarks/bench_web.py [--watchers 300] [--changes 200] [--concurrency 8] [--server wsgiref]
+
+The web server runs in this process on an ephemeral port, under waitress when it is
+installed (or the standard library server with --server wsgiref). The MQTT broker
+is cut out: the client is marked connected and its publish() does nothing, the way
+bench_pipeline.py hands messages straight to on_message.
+
+--watchers clients hold /api/v1/events open, all read by one selector thread.
+--concurrency threads then toggle email sending through the JSON API --changes
+times in total. Reported: time to connect the watchers, API latency and
+throughput while they are connected, fan-out latency (from the start of the API
+request to a watcher reading the state it produced), how many watchers ended on
+the final state, the server's thread count and peak RSS.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import re
+import resource
+import selectors
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'scheduler-web-server'))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+EVENT_ID_PATTERN = re.compile(rb'^id: \S+-(\d+)$', re.M)
+
+
+class Watchers:
+    """Event stream clients on raw sockets, read by one selector thread; records when each state arrives."""
+
+    def __init__(self, port, count):
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        # watcher -> [(seq, received at)]
+        self.received = {}
+        self._lock = threading.Lock()
+        request = (f"GET /api/v1/events HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                   f"Accept: text/event-stream\r\n\r\n").encode()
+        for n in range(count):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(request)
+            sock.setblocking(False)
+            self.buffers[n] = b''
+            self.received[n] = []
+            self.selector.register(sock, selectors.EVENT_READ, n)
+        self.closed = 0
+        threading.Thread(target=self._run, name='watchers', daemon=True).start()
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select(timeout=1):
+                n = key.data
+                try:
+                    data = key.fileobj.recv(65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                now = time.time()
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    self.closed += 1
+                    continue
+                buffer = self.buffers[n] + data
+                # Events end in a blank line; chunked transfer framing only ever sits between them
+                end = buffer.rfind(b'\n\n')
+                if end < 0:
+                    self.buffers[n] = buffer
+                    continue
+                self.buffers[n] = buffer[end + 2:]
+                seqs = [int(seq) for seq in EVENT_ID_PATTERN.findall(buffer[:end])]
+                with self._lock:
+                    self.received[n].extend((seq, now) for seq in seqs)
+
+    def count_with(self, predicate):
+        with self._lock:
+            return sum(1 for events in self.received.values() if predicate(events))
+
+
+def api_client(port, count, results, lock):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    for _ in range(count):
+        started = time.time()
+        connection.request('POST', '/api/v1/email_sending/toggle')
+        response = connection.getresponse()
+        state = json.loads(response.read())
+        with lock:
+            results.append((state['seq'], started, time.time()))
+    connection.close()
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def report_latency(name, values):
+    if not values:
+        print(f"{name:<22} no samples")
+        return
+    values = sorted(values)
+    p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+    print(f"{name:<22} p50 {statistics.median(values) * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms   "
+          f"max {values[-1] * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--watchers', type=int, default=300, help='open /api/v1/events streams')
+    parser.add_argument('--changes', type=int, default=200, help='state changes made through the API')
+    parser.add_argument('--concurrency', type=int, default=8, help='API clients making the changes')
+    parser.add_argument('--server', choices=('auto', 'wsgiref'), default='auto',
+                        help='auto uses waitress when installed')
+    parser.add_argument('--threads', type=int, default=16, help="the server's WEB_THREADS")
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update({
+            'SCHEDULER_STATE_FILE': os.path.join(workdir, 'scheduler_state.json'),
+            'SSE_MAX_CLIENTS': str(args.watchers),
+            'METRICS_PORT': '0',
+        })
+        import scheduler_web_server as web
+        # A request waiting a moment for a thread is part of what is measured
+        logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+        import wsgi_server
+        if args.server == 'wsgiref':
+            wsgi_server.waitress = None
+        # No broker: publishing succeeds without going anywhere
+        web.background_started = True
+        web.client.publish = lambda *a, **k: mqtt.MQTTMessageInfo(0)
+
+        server = wsgi_server.Server(web.app, host='127.0.0.1', port=0, threads=args.threads,
+                                    max_streams=args.watchers)
+        threading.Thread(target=server.run, name='web-server', daemon=True).start()
+        first_seq = web.state_seq
+
+        started = time.perf_counter()
+        watchers = Watchers(server.port, args.watchers)
+        wait_for(lambda: watchers.count_with(bool) == args.watchers, args.timeout)
+        connect_time = time.perf_counter() - started
+        print(f"server                 {server.name}, {args.watchers} watchers, {args.changes} changes "
+              f"from {args.concurrency} clients")
+        print(f"{'watchers connected':<22} {watchers.count_with(bool)} in {connect_time:.2f}s")
+
+        results = []
+        lock = threading.Lock()
+        clients = [threading.Thread(target=api_client,
+                                    args=(server.port, args.changes // args.concurrency + (n < args.changes % args.concurrency),
+                                          results, lock))
+                   for n in range(args.concurrency)]
+        started = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - started
+        final_seq = max(seq for seq, _, _ in results)
+        wait_for(lambda: watchers.count_with(lambda events: events[-1][0] == final_seq) == args.watchers, args.timeout)
+        threads = threading.active_count()
+
+        print(f"{'api throughput':<22} {len(results) / elapsed:10,.0f} changes/s")
+        report_latency('api latency', [finished - sent for _, sent, finished in results])
+        request_started = {seq: sent for seq, sent, _ in results}
+        fanout = [received - request_started[seq]
+                  for events in watchers.received.values() for seq, received in events if seq in request_started]
+        report_latency('fan-out latency', fanout)
+        seen = sum(1 for events in watchers.received.values() for seq, _ in events if seq > first_seq)
+        print(f"{'states delivered':<22} {seen} of {args.watchers * len(results)} "
+              f"(a watcher that falls behind skips to the latest)")
+        print(f"{'on the final state':<22} {watchers.count_with(lambda events: events[-1][0] == final_seq)} "
+              f"of {args.watchers}, {watchers.closed} stream(s) closed")
+        print(f"{'threads':<22} {threads}")
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+        print(f"{'peak RSS':<22} {peak_mb:10,.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""In-process stand-ins for Frigate, an SMTP server and an IMAP server, for the benchmarks.
+
+Each one listens on 127.0.0.1 on a free port and serves from daemon threads. They
+implement just enough of each protocol for the services in this repository.
+"""
+import email
+import http.server
+import re
+import select
+import socketserver
+import threading
+import time
+
+
+def fake_jpeg(size):
+    """Bytes that mail clients and the email package recognise as a JPEG, padded to `size`."""
+    head = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    return head + b'\x00' * max(0, size - len(head) - 2) + b'\xff\xd9'
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+class FakeFrigate:
+    """Serves /api/events/<id>/snapshot.jpg, /clip.mp4 and the event JSON, after an optional delay."""
+
+    def __init__(self, snapshot_bytes=60_000, clip_bytes=2_000_000, delay=0.0):
+        self.snapshot = fake_jpeg(snapshot_bytes)
+        self.clip = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * max(0, clip_bytes - 12)
+        self.delay = delay
+        self.requests = 0
+        frigate = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                frigate.requests += 1
+                if frigate.delay:
+                    time.sleep(frigate.delay)
+                path = self.path.split('?', 1)[0]
+                if path.endswith('/snapshot.jpg'):
+                    body, content_type = frigate.snapshot, 'image/jpeg'
+                elif path.endswith('/clip.mp4'):
+                    body, content_type = frigate.clip, 'video/mp4'
+                elif path.startswith('/api/events/'):
+                    body = b'{"camera": "front", "start_time": %f, "end_time": null}' % time.time()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = _serve(self.server)
+
+
+class SMTPSink:
+    """Accepts every message and calls `on_message(raw bytes, received at)`; `delay` is added per message."""
+
+    def __init__(self, on_message, delay=0.0):
+        self.on_message = on_message
+        self.delay = delay
+        self.sessions = 0
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                sink.sessions += 1
+                self.reply(b'220 sink ESMTP')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.strip().split(b' ', 1)[0].upper()
+                    if command in (b'EHLO', b'HELO'):
+                        self.reply(b'250-sink\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN')
+                    elif command == b'AUTH':
+                        self.reply(b'235 2.7.0 Accepted')
+                    elif command == b'DATA':
+                        self.reply(b'354 End data with <CR><LF>.<CR><LF>')
+                        lines = []
+                        while True:
+                            line = self.rfile.readline()
+                            if not line or line == b'.\r\n':
+                                break
+                            lines.append(line[1:] if line.startswith(b'..') else line)
+                        if sink.delay:
+                            time.sleep(sink.delay)
+                        sink.on_message(b''.join(lines), time.time())
+                        self.reply(b'250 2.0.0 Ok: queued')
+                    elif command == b'QUIT':
+                        self.reply(b'221 Bye')
+                        return
+                    else:
+                        # MAIL, RCPT, RSET, NOOP
+                        self.reply(b'250 Ok')
+
+            def reply(self, text):
+                self.wfile.write(text + b'\r\n')
+
+        self.server = _ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.port = _serve(self.server)
+
+
+class FakeIMAP:
+    """A few IMAP4rev1 commands over any number of mailboxes: enough for UID SEARCH/FETCH/STORE/EXPUNGE and IDLE."""
+
+    def __init__(self):
+        self.mailboxes = {}
+        self.next_uid = 1
+        self._lock = threading.Lock()
+        imap = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                self.mailbox = 'INBOX'
+                self.reply(b'* OK fake IMAP ready')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    tag, _, rest = line.strip().decode().partition(' ')
+                    command, _, args = rest.partition(' ')
+                    handler = getattr(self, f"do_{command.upper()}", None)
+                    if handler is None:
+                        self.reply(f"{tag} OK {command} done".encode())
+                    elif handler(tag, args) is False:
+                        return
+
+            def reply(self, data):
+                self.wfile.write(data + b'\r\n')
+
+            def do_CAPABILITY(self, tag, args):
+                self.reply(b'* CAPABILITY IMAP4rev1 IDLE UIDPLUS')
+                self.reply(f"{tag} OK CAPABILITY done".encode())
+
+            def do_LOGIN(self, tag, args):
+                self.reply(f"{tag} OK LOGIN done".encode())
+
+            def do_LOGOUT(self, tag, args):
+                self.reply(b'* BYE')
+                self.reply(f"{tag} OK LOGOUT done".encode())
+                return False
+
+            def do_SELECT(self, tag, args):
+                self.mailbox = imap.normalise(args)
+                messages = imap.box(self.mailbox)
+                self.reply(f"* {len(messages)} EXISTS".encode())
+                self.reply(b'* OK [UIDVALIDITY 1] UIDs valid')
+                self.reply(f"* OK [UIDNEXT {imap.next_uid}] next".encode())
+                self.reply(f"{tag} OK [READ-WRITE] SELECT done".encode())
+
+            def do_NOOP(self, tag, args):
+                self.reply(f"{tag} OK NOOP done".encode())
+
+            def do_EXPUNGE(self, tag, args):
+                imap.expunge(self.mailbox, None)
+                self.reply(f"{tag} OK EXPUNGE done".encode())
+
+            def do_IDLE(self, tag, args):
+                with imap._lock:
+                    seen = len(imap.box(self.mailbox))
+                self.reply(b'+ idling')
+                while True:
+                    if select.select([self.connection], [], [], 0.02)[0]:
+                        self.rfile.readline()  # DONE
+                        break
+                    with imap._lock:
+                        count = len(imap.box(self.mailbox))
+                    if count != seen:
+                        self.reply(f"* {count} EXISTS".encode())
+                        seen = count
+                self.reply(f"{tag} OK IDLE terminated".encode())
+
+            def do_UID(self, tag, args):
+                command, _, args = args.partition(' ')
+                command = command.upper()
+                messages = imap.box(self.mailbox)
+                if command == 'SEARCH':
+                    found = imap.search(self.mailbox, args)
+                    self.reply(('* SEARCH' + ''.join(f" {uid}" for uid in found)).encode())
+                elif command == 'FETCH':
+                    uid_set, _, items = args.partition(' ')
+                    for index, uid in enumerate(sorted(messages), start=1):
+                        if uid not in imap.uids(self.mailbox, uid_set):
+                            continue
+                        raw = messages[uid]['raw']
+                        if 'HEADER.FIELDS' in items:
+                            match = re.search(rb'^Subject:.*?\r\n(?![ \t])', raw, re.M | re.S)
+                            data = (match.group(0) if match else b'') + b'\r\n'
+                            name = 'BODY[HEADER.FIELDS (SUBJECT)]'
+                        else:
+                            data, name = raw, 'RFC822'
+                        self.wfile.write(f"* {index} FETCH (UID {uid} {name} {{{len(data)}}}\r\n".encode() + data + b')\r\n')
+                elif command == 'STORE':
+                    uid_set = args.split(' ', 1)[0]
+                    for uid in imap.uids(self.mailbox, uid_set):
+                        messages[uid]['deleted'] = True
+                elif command == 'EXPUNGE':
+                    imap.expunge(self.mailbox, imap.uids(self.mailbox, args))
+                self.reply(f"{tag} OK UID {command} done".encode())
+
+        self.server = _ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.port = _serve(self.server)
+
+    @staticmethod
+    def normalise(name):
+        name = name.strip().strip('"')
+        return 'INBOX' if name.upper() == 'INBOX' else name
+
+    def box(self, name):
+        return self.mailboxes.setdefault(name, {})
+
+    def add(self, raw, mailbox='INBOX'):
+        with self._lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.box(self.normalise(mailbox))[uid] = {'raw': raw, 'deleted': False}
+        return uid
+
+    def uids(self, mailbox, uid_set):
+        messages = self.box(mailbox)
+        found = set()
+        for part in uid_set.split(','):
+            if ':' in part:
+                low, high = part.split(':')
+                high = max(messages, default=0) if high == '*' else int(high)
+                low, high = sorted((int(low), high))
+                found.update(uid for uid in messages if low <= uid <= high)
+                if part.endswith('*') and messages:
+                    found.add(max(messages))
+            elif part:
+                found.add(int(part))
+        return sorted(uid for uid in found if uid in messages)
+
+    def search(self, mailbox, criteria):
+        messages = self.box(mailbox)
+        if criteria.upper().startswith('UID '):
+            return self.uids(mailbox, criteria[4:])
+        for header in ('Message-ID', 'Subject'):
+            match = re.search(rf'(?:HEADER )?{header} "([^"]+)"', criteria, re.I)
+            if match:
+                needle = match.group(1)
+                return [uid for uid, message in sorted(messages.items())
+                        if needle in str(self.headers(message['raw'])[header] or '')]
+        return sorted(messages)
+
+    @staticmethod
+    def headers(raw):
+        # Only the header block: clip emails are megabytes of base64
+        return email.message_from_bytes(raw.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n')
+
+    def expunge(self, mailbox, uids):
+        with self._lock:
+            messages = self.box(mailbox)
+            for uid in list(messages):
+                if messages[uid]['deleted'] and (uids is None or uid in uids):
+                    del messages[uid]
+
+    def count(self, mailbox='INBOX'):
+        with self._lock:
+            return len(self.box(self.normalise(mailbox)))
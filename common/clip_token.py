@@ -0,0 +1,45 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+import time
+
+# Shared by mqtt-to-email (signs) and email-listener (verifies); unset keeps the old body-parsing requests
+CLIP_TOKEN_SECRET = os.getenv('CLIP_TOKEN_SECRET')
+CLIP_TOKEN_TTL = float(os.getenv('CLIP_TOKEN_TTL', 7 * 24 * 3600))  # seconds a clip link stays valid
+
+CLIP_REQUEST_SUBJECT = 'Send Clip'
+SIGNATURE_BYTES = 12
+
+# <event id>.<issued, hex>.<signature>; Frigate event IDs are made of word characters, dots and dashes
+TOKEN_PATTERN = re.compile(r'([\w.-]+)\.([0-9a-f]+)\.([\w-]{16})(?![\w-])')
+
+
+def _signature(secret, event_id, issued):
+    digest = hmac.new(secret.encode(), f"{event_id}.{issued:x}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).decode()
+
+
+def make_token(event_id, secret, issued=None):
+    issued = int(time.time() if issued is None else issued)
+    return f"{event_id}.{issued:x}.{_signature(secret, event_id, issued)}"
+
+
+def request_subject(event_id, secret):
+    return f"{CLIP_REQUEST_SUBJECT} {make_token(event_id, secret)}"
+
+
+def verify_token(subject, secret, ttl, now=None):
+    """(event ID, signature) from a clip request subject; raises ValueError if it is missing, forged or expired."""
+    match = TOKEN_PATTERN.search(subject or '')
+    if not match:
+        raise ValueError("no clip token in subject")
+    event_id, issued, signature = match.groups()
+    issued = int(issued, 16)
+    if not hmac.compare_digest(signature, _signature(secret, event_id, issued)):
+        raise ValueError(f"bad signature for event {event_id}")
+    now = time.time() if now is None else now
+    if now - issued > ttl:
+        raise ValueError(f"token for event {event_id} expired {now - issued - ttl:.0f} seconds ago")
+    return event_id, signature
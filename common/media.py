@@ -0,0 +1,257 @@
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+
+def cache_name(event_id, kind, variant=''):
+    """File name for one piece of event media, safe to use on any file system."""
+    name = f"{event_id}.{kind}" if not variant else f"{event_id}.{kind}.{variant}"
+    return re.sub(r'[^A-Za-z0-9._-]', '_', name)
+
+
+class MediaCache:
+    """Size-bounded on-disk LRU cache of event media.
+
+    Files are written under a temporary name and renamed into place, so another
+    service sharing the directory never reads half a file. Use is tracked by
+    modification time: a hit touches the file, and once the directory grows past
+    `max_bytes` the least recently used files are removed. The index is rebuilt from
+    the directory at least every `rescan_interval` seconds before evicting, so files
+    the other service added count too and the shared directory stays within
+    `max_bytes` in total, give or take what was written since the last rescan.
+    """
+
+    def __init__(self, directory, max_bytes, rescan_interval=5):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+        # name -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the index from the files on disk, then evict."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith('.part'):
+                # Left behind by a download that did not finish; a recent one may be the other service's
+                if stat.st_mtime < time.time() - 3600:
+                    os.remove(entry.path)
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        with self._lock:
+            self._scanned_at = time.monotonic()
+            self._entries = entries
+            self._size = sum(entries.values())
+        self._evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """Path of a cached file, marked as recently used, or None."""
+        path = self.path(name)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._entries.pop(name, 0)
+            return None
+        with self._lock:
+            # The file may have been added by the other service sharing the directory
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+        return path
+
+    def temp_path(self, name):
+        return self.path(f"{name}.{uuid.uuid4().hex}.part")
+
+    def commit(self, name, temp_path):
+        """Move a finished download into the cache and return its final path."""
+        path = self.path(name)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            # A scan costs a stat per file, so it is not repeated on every download
+            rescan = self._size > self.max_bytes or time.monotonic() - self._scanned_at >= self.rescan_interval
+        if rescan:
+            self._scan()
+        return path
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.max_bytes or len(self._entries) <= 1:
+                    return
+                name, size = self._entries.popitem(last=False)
+                self._size -= size
+            try:
+                os.remove(self.path(name))
+                logging.debug(f"Evicted {name} ({size} bytes) from the media cache")
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+
+class MediaFetcher:
+    """Fetches event snapshots and clips from Frigate over one pooled keep-alive session.
+
+    With a `cache`, downloaded media is kept on disk keyed by event ID, so a clip that
+    was prefetched when its event ended is served locally when someone asks for it.
+    """
+
+    def __init__(self, frigate_url, cache=None, timeout=(5, 60), pool_size=4):
+        self.frigate_url = frigate_url.rstrip('/')
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._prefetcher = None
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, frigate_url, environ=None):
+        env = os.environ if environ is None else environ
+        max_bytes = int(env.get('MEDIA_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 0 disables the cache
+        cache = MediaCache(env.get('MEDIA_CACHE_DIR', 'data/media'), max_bytes) if max_bytes > 0 else None
+        return cls(frigate_url, cache,
+                   timeout=(float(env.get('FRIGATE_CONNECT_TIMEOUT', 5)), float(env.get('FRIGATE_READ_TIMEOUT', 60))),
+                   pool_size=int(env.get('MEDIA_POOL_SIZE', 4)))  # keep-alive connections to Frigate
+
+    def url(self, path):
+        return f"{self.frigate_url}{path}"
+
+    def clip_url(self, event_id):
+        return self.url(f"/api/events/{event_id}/clip.mp4")
+
+    def get(self, path, params=None):
+        response = self.session.get(self.url(path), params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def head_size(self, path):
+        """Content-Length of a resource, or None when Frigate does not say."""
+        try:
+            response = self.session.head(self.url(path), allow_redirects=True, timeout=self.timeout)
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            return int(length) if length else None
+        except Exception as e:
+            logging.debug(f"HEAD {path} gave no usable size. Error: {e}")
+            return None
+
+    def download(self, path, fileobj, params=None):
+        """Stream a resource into an open file and rewind it. Returns the number of bytes."""
+        with self.session.get(self.url(path), params=params, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                fileobj.write(chunk)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        return size
+
+    def download_to_path(self, path, target, params=None):
+        with open(target, 'wb') as f:
+            self.download(path, f, params)
+        return target
+
+    def _cached_download(self, name, path, params=None):
+        temp_path = self.cache.temp_path(name)
+        try:
+            self.download_to_path(path, temp_path, params)
+            return self.cache.commit(name, temp_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def snapshot(self, event_id, params=None, refresh=False):
+        """Snapshot JPEG bytes; `params` are Frigate's crop/height/quality options.
+
+        `refresh` downloads it again instead of using the cached copy, for when Frigate has a better one.
+        """
+        path = f"/api/events/{event_id}/snapshot.jpg"
+        if self.cache is None:
+            return self.get(path, params).content
+        variant = '-'.join(f"{key}{value}" for key, value in sorted((params or {}).items()))
+        name = cache_name(event_id, 'jpg', variant)
+        cached = None if refresh else self.cache.get(name)
+        if cached is not None:
+            try:
+                with open(cached, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass  # evicted by the other service in the meantime
+        with open(self._cached_download(name, path, params), 'rb') as f:
+            return f.read()
+
+    def cached_clip(self, event_id):
+        """Path of the clip if it is already on disk, otherwise None."""
+        if self.cache is None:
+            return None
+        return self.cache.get(cache_name(event_id, 'mp4'))
+
+    def clip(self, event_id, workdir):
+        """Path of the event's clip, downloading it into the cache (or `workdir` without one)."""
+        path = f"/api/events/{event_id}/clip.mp4"
+        if self.cache is None:
+            return self.download_to_path(path, os.path.join(workdir, 'clip.mp4'))
+        name = cache_name(event_id, 'mp4')
+        return self.cache.get(name) or self._cached_download(name, path)
+
+    def prefetch_clip(self, event_id, delay=0):
+        """Download a clip into the cache in the background, after `delay` seconds."""
+        if self.cache is None:
+            return
+        with self._in_flight_lock:
+            if event_id in self._in_flight:
+                return
+            self._in_flight.add(event_id)
+            if self._prefetcher is None:
+                self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clip-prefetch')
+        if delay > 0:
+            timer = threading.Timer(delay, self._prefetcher.submit, args=(self._prefetch, event_id))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._prefetcher.submit(self._prefetch, event_id)
+
+    def _prefetch(self, event_id):
+        started = time.monotonic()
+        try:
+            if self.cached_clip(event_id) is None:
+                path = self.clip(event_id, None)
+                logging.debug(f"Prefetched clip for event {event_id} ({os.path.getsize(path)} bytes) "
+                              f"in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logging.warning(f"Failed to prefetch clip for event {event_id}. Error: {e}")
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(event_id)
@@ -0,0 +1,51 @@
+import base64
+import email.policy
+from email.mime.base import MIMEBase
+
+# 57 raw bytes encode to exactly one 76 character base64 line
+BASE64_LINE_BYTES = 57
+READ_SIZE = BASE64_LINE_BYTES * 1024
+
+
+def attachment_part(filename, maintype='application', subtype='octet-stream'):
+    """Headers for an attachment whose body is streamed separately by iter_message."""
+    part = MIMEBase(maintype, subtype, name=filename)
+    del part['MIME-Version']
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def iter_base64(fileobj):
+    """Base64-encode a file in fixed-size reads, yielding CRLF-terminated 76 character lines."""
+    while True:
+        chunk = fileobj.read(READ_SIZE)
+        if not chunk:
+            return
+        yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+
+def iter_message(msg, attachments):
+    """Yield `msg` as CRLF-terminated bytes with file-backed attachments appended to it.
+
+    `msg` is a multipart message holding the headers and the small inline parts.
+    `attachments` is a list of (part, fileobj) pairs from attachment_part(); each
+    file is read and encoded a chunk at a time, so memory stays bounded however
+    large the attachments are.
+    """
+    boundary = msg.get_boundary()
+    if boundary is None:
+        # The generator picks a boundary on first serialisation; fix it so we can reuse it
+        msg.as_bytes(policy=email.policy.SMTP)
+        boundary = msg.get_boundary()
+    boundary = boundary.encode('ascii')
+
+    head = msg.as_bytes(policy=email.policy.SMTP)
+    head = head[:head.rindex(b'--' + boundary + b'--')]
+    yield head
+
+    for part, fileobj in attachments:
+        yield b'--' + boundary + b'\r\n' + part.as_bytes(policy=email.policy.SMTP)
+        yield from iter_base64(fileobj)
+
+    yield b'--' + boundary + b'--\r\n'
@@ -0,0 +1,140 @@
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+FULL_DAY = {'start_time': '00:00', 'end_time': '23:59'}
+
+
+def to_minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def load_timezone(name):
+    """The ZoneInfo for `name`, None for no name; raises ValueError if it cannot be loaded."""
+    if not name:
+        return None
+    if ZoneInfo is None:
+        raise ValueError(f"zoneinfo is not available to load time zone '{name}'")
+    try:
+        return ZoneInfo(name)
+    except Exception as e:
+        # Also what a missing time zone database looks like; the tzdata package provides one
+        raise ValueError(f"Unknown time zone '{name}': {e}") from e
+
+
+class CompiledSchedule:
+    """A weekly schedule compiled into sorted minute-of-week intervals.
+
+    Each day maps to one window ({"start_time": "HH:MM", "end_time": "HH:MM"}) or a list
+    of them. End times are inclusive to the minute, as in the original string
+    comparison, and a window ending before it starts runs past midnight into the
+    next day. A day left out of the schedule is allowed all day.
+
+    allowed() answers with a bisect and remembers when the answer next changes, so
+    until then a call is a single comparison.
+    """
+
+    def __init__(self, schedule, timezone=None):
+        self.timezone = timezone
+        if isinstance(timezone, str):
+            try:
+                self.timezone = load_timezone(timezone)
+            except ValueError as e:
+                logging.error(f"{e}, using local time")
+                self.timezone = None
+        intervals = []
+        for day_index, day in enumerate(DAYS):
+            windows = schedule.get(day, FULL_DAY)
+            if isinstance(windows, dict):
+                windows = [windows]
+            for window in windows:
+                start = day_index * MINUTES_PER_DAY + to_minutes(window['start_time'])
+                end = day_index * MINUTES_PER_DAY + to_minutes(window['end_time']) + 1
+                if end <= start:
+                    end += MINUTES_PER_DAY
+                if end > MINUTES_PER_WEEK:
+                    # Sunday night into Monday morning wraps to the start of the week
+                    intervals.append((0, end - MINUTES_PER_WEEK))
+                    end = MINUTES_PER_WEEK
+                intervals.append((start, end))
+
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.intervals = merged
+        self._starts = [start for start, _ in merged]
+        self._lock = threading.Lock()
+        # (valid from, valid until, answer), swapped as one tuple so readers never see half an update
+        self._cached = (0.0, 0.0, True)
+
+    def _local(self, now):
+        if self.timezone is not None:
+            return datetime.fromtimestamp(now, self.timezone)
+        return datetime.fromtimestamp(now).astimezone()
+
+    def _evaluate(self, now):
+        moment = self._local(now)
+        minute_of_week = moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+        index = bisect.bisect_right(self._starts, minute_of_week) - 1
+        inside = index >= 0 and minute_of_week < self.intervals[index][1]
+
+        # The next minute of the week at which the answer flips
+        if not self.intervals:
+            return False, now + MINUTES_PER_WEEK * 60
+        if inside:
+            transition = self.intervals[index][1]
+            if transition == MINUTES_PER_WEEK and self.intervals[0][0] == 0:
+                transition = MINUTES_PER_WEEK + self.intervals[0][1]
+            if transition >= MINUTES_PER_WEEK + MINUTES_PER_WEEK:
+                return True, now + MINUTES_PER_WEEK * 60
+        elif index + 1 < len(self.intervals):
+            transition = self.intervals[index + 1][0]
+        else:
+            transition = MINUTES_PER_WEEK + self.intervals[0][0]
+
+        # Step in wall-clock time, so daylight saving changes land the transition correctly
+        week_start = moment.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=moment.weekday())
+        valid_until = (week_start + timedelta(minutes=transition)).timestamp()
+        if self.timezone is None:
+            # A fixed UTC offset cannot see daylight saving changes coming; re-check hourly
+            valid_until = min(valid_until, now + 3600)
+        return inside, max(valid_until, now + 1)
+
+    def allowed(self, now=None):
+        now = time.time() if now is None else now
+        valid_from, valid_until, value = self._cached
+        if valid_from <= now < valid_until:
+            return value
+        with self._lock:
+            valid_from, valid_until, value = self._cached
+            if not valid_from <= now < valid_until:
+                value, valid_until = self._evaluate(now)
+                self._cached = (now, valid_until, value)
+            return value
+
+    def next_transition(self, now=None):
+        """(timestamp, allowed afterwards) for the next time the answer changes."""
+        now = time.time() if now is None else now
+        inside, valid_until = self._evaluate(now)
+        if not self.intervals:
+            return valid_until, False
+        return valid_until, not inside
+
+    def describe(self):
+        return ', '.join(f"{DAYS[start // MINUTES_PER_DAY].capitalize()} {start % MINUTES_PER_DAY // 60:02d}:"
+                         f"{start % 60:02d} for {(end - start) // 60}h{(end - start) % 60:02d}m"
+                         for start, end in self.intervals)
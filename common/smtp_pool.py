@@ -0,0 +1,172 @@
+import contextlib
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+SMTP_SECURITY_MODES = ('starttls', 'ssl', 'none')
+
+
+class SMTPPool:
+    """Keeps up to `size` authenticated SMTP sessions open and reuses them across messages.
+
+    Sessions are handed out most-recently-used first. A session that sat idle longer
+    than `probe_after` seconds is checked with NOOP before reuse, and one idle longer
+    than `max_idle` is assumed dead and replaced without asking.
+    """
+
+    def __init__(self, host, port, username=None, password=None, size=2, security='starttls',
+                 timeout=30, probe_after=10, max_idle=240):
+        if security not in SMTP_SECURITY_MODES:
+            raise ValueError(f"Unknown SMTP security mode '{security}'")
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = max(1, size)
+        self.security = security
+        self.timeout = timeout
+        self.probe_after = probe_after
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    @classmethod
+    def from_env(cls, username, password, environ=None):
+        env = os.environ if environ is None else environ
+        return cls(env.get('SMTP_HOST', 'smtp.gmail.com'), int(env.get('SMTP_PORT', 587)), username, password,
+                   size=int(env.get('SMTP_POOL_SIZE', 2)),
+                   security=env.get('SMTP_SECURITY', 'starttls').lower(),  # starttls, ssl or none
+                   timeout=float(env.get('SMTP_TIMEOUT', 30)),
+                   probe_after=float(env.get('SMTP_PROBE_AFTER', 10)),  # seconds idle before a NOOP probe
+                   max_idle=float(env.get('SMTP_MAX_IDLE', 240)))  # seconds idle before a session is dropped unprobed
+
+    def _connect(self):
+        logging.debug(f"Opening SMTP session to {self.host}:{self.port}")
+        if self.security == 'ssl':
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == 'starttls':
+                server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _is_alive(self, server):
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _checkout(self):
+        while True:
+            try:
+                server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.max_idle:
+                logging.debug(f"Dropping SMTP session idle for {idle_for:.0f} seconds")
+                self._close(server)
+            elif idle_for > self.probe_after and not self._is_alive(server):
+                logging.debug("SMTP session went stale, reconnecting")
+                self._close(server)
+            else:
+                return server
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow an authenticated session; it goes back to the pool unless the block raised."""
+        self._slots.acquire()
+        server = None
+        try:
+            server = self._checkout()
+            yield server
+        except Exception:
+            if server is not None:
+                self._close(server)
+                server = None
+            raise
+        finally:
+            if server is not None:
+                self._idle.put((server, time.monotonic()))
+            self._slots.release()
+
+    def warm(self):
+        """Open sessions up front so the first messages skip the TLS and AUTH round trips."""
+        servers = []
+        try:
+            for _ in range(self.size - self._idle.qsize()):
+                servers.append(self._connect())
+        except Exception as e:
+            logging.error(f"Failed to warm SMTP pool. Error: {e}")
+        for server in servers:
+            self._idle.put((server, time.monotonic()))
+
+    def send_stream(self, from_addr, to_addrs, chunks):
+        """Send a message given as an iterable of CRLF-terminated byte chunks without joining them.
+
+        The chunks are written straight into the DATA phase (with dot-stuffing), so the
+        whole message never has to exist in memory at once.
+        """
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        for attempt in range(2):
+            data_started = False
+            try:
+                with self.connection() as server:
+                    server.ehlo_or_helo_if_needed()
+                    code, resp = server.mail(from_addr)
+                    if code != 250:
+                        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+                    refused = {}
+                    for addr in to_addrs:
+                        code, resp = server.rcpt(addr)
+                        if code not in (250, 251):
+                            refused[addr] = (code, resp)
+                    if len(refused) == len(to_addrs):
+                        raise smtplib.SMTPRecipientsRefused(refused)
+                    code, resp = server.docmd('DATA')
+                    if code != 354:
+                        raise smtplib.SMTPDataError(code, resp)
+
+                    data_started = True
+                    at_line_start = True
+                    for chunk in chunks:
+                        if not chunk:
+                            continue
+                        chunk = chunk.replace(b'\n.', b'\n..')
+                        if at_line_start and chunk.startswith(b'.'):
+                            chunk = b'.' + chunk
+                        server.send(chunk)
+                        at_line_start = chunk.endswith(b'\n')
+                    server.send(b'.\r\n' if at_line_start else b'\r\n.\r\n')
+
+                    code, resp = server.getreply()
+                    if code != 250:
+                        raise smtplib.SMTPDataError(code, resp)
+                    return refused
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                # Once DATA has started the chunks are partly consumed and cannot be replayed
+                if attempt or data_started:
+                    raise
+                logging.debug(f"SMTP session lost before DATA, retrying on a new one. Error: {e}")
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(server)
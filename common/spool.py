@@ -0,0 +1,258 @@
+import email.generator
+import email.message
+import email.policy
+import json
+import logging
+import os
+import random
+import shutil
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+
+from common.metrics import Counter, Gauge, Histogram
+
+# How long a worker may hold a message before another worker considers it abandoned
+LEASE_SECONDS = 600
+READ_SIZE = 256 * 1024
+
+MAIL_SENT = Counter('mail_sent_total', 'Emails accepted by the SMTP server')
+MAIL_FAILURES = Counter('mail_send_failures_total', 'Failed delivery attempts, by what happened next', ['outcome'])
+SMTP_SESSION_SECONDS = Histogram('smtp_session_seconds', 'Time to hand one spooled email to the SMTP server')
+ALERT_LATENCY_SECONDS = Histogram('alert_latency_seconds', 'From the triggering event to SMTP accept')
+
+# Every spool in the process, for the pending gauge
+spools = weakref.WeakSet()
+Gauge('mail_spool_pending', 'Emails waiting in the spool for delivery', lambda: sum(spool.pending() for spool in list(spools)))
+
+
+def is_permanent(error):
+    """5xx replies will not get better by retrying; authentication failures are left to retry until fixed."""
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def iter_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class MailSpool:
+    """On-disk outbound queue: messages are written to disk before any send is attempted.
+
+    Each message is stored fully encoded as an .eml file under `directory`/queue and
+    tracked in a SQLite table with its attempt count and next attempt time. Worker
+    threads stream the files to `smtp_pool`. Transient failures are retried with
+    exponential backoff. A permanent failure, or running out of attempts, moves the
+    file to `directory`/dead next to a .json note with the last error. `on_sent(tag)`
+    is called after each successful send.
+
+    Only one spool per directory is allowed in a process, since each would lease the
+    other's messages; notifiers that should send from the same directory share the
+    one MailSpool instead.
+    """
+
+    # Directories (real paths) with a spool in this process
+    _directories = set()
+    _directories_lock = threading.Lock()
+
+    def __init__(self, directory, smtp_pool, workers=2, max_attempts=10, backoff_base=30, backoff_max=3600,
+                 rate_per_minute=0, on_sent=None):
+        real_directory = os.path.realpath(directory)
+        with MailSpool._directories_lock:
+            if real_directory in MailSpool._directories:
+                raise ValueError(f"Spool directory {directory} is already used by another spool; share that spool instead")
+            MailSpool._directories.add(real_directory)
+        self.directory = directory
+        self.smtp_pool = smtp_pool
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0
+        self.on_sent = on_sent
+        self.queue_dir = os.path.join(directory, 'queue')
+        self.dead_dir = os.path.join(directory, 'dead')
+        os.makedirs(self.queue_dir, exist_ok=True)
+        os.makedirs(self.dead_dir, exist_ok=True)
+
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'spool.sqlite3'), check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                             'id INTEGER PRIMARY KEY, created REAL NOT NULL, sender TEXT NOT NULL, '
+                             'recipients TEXT NOT NULL, path TEXT NOT NULL, tag TEXT, '
+                             'attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, last_error TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS messages_next_attempt ON messages (next_attempt)')
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(messages)')}
+            if 'event_time' not in columns:
+                # Spools created before the latency metric
+                self._db.execute('ALTER TABLE messages ADD COLUMN event_time REAL')
+        self._wakeup = threading.Condition()
+        self._rate_lock = threading.Lock()
+        self._next_send = 0.0
+        self._threads = []
+        self._remove_orphans()
+        spools.add(self)
+
+    @classmethod
+    def from_env(cls, smtp_pool, on_sent=None, environ=None):
+        env = os.environ if environ is None else environ
+        return cls(env.get('SPOOL_DIR', 'data/spool'), smtp_pool,
+                   workers=int(env.get('SPOOL_WORKERS', env.get('SMTP_POOL_SIZE', 2))),
+                   max_attempts=int(env.get('SPOOL_MAX_ATTEMPTS', 10)),
+                   backoff_base=float(env.get('SPOOL_BACKOFF_BASE', 30)),  # seconds before the first retry, doubled per attempt
+                   backoff_max=float(env.get('SPOOL_BACKOFF_MAX', 3600)),
+                   rate_per_minute=float(env.get('SMTP_RATE_PER_MINUTE', 0)),  # 0 means unthrottled
+                   on_sent=on_sent)
+
+    def _remove_orphans(self):
+        # Files written just before a crash, before their row was committed
+        with self._db_lock:
+            known = {os.path.basename(row[0]) for row in self._db.execute('SELECT path FROM messages')}
+        for name in os.listdir(self.queue_dir):
+            if name not in known:
+                os.remove(os.path.join(self.queue_dir, name))
+
+    def enqueue(self, sender, recipients, message, tag=None, event_time=None):
+        """Store a message for delivery: an email.message.Message, bytes, or an iterable of CRLF byte chunks.
+
+        `event_time` is when the event behind the email happened, for the alert latency metric.
+        """
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        path = os.path.join(self.queue_dir, f"{uuid.uuid4().hex}.eml")
+        try:
+            with open(path, 'wb') as f:
+                if isinstance(message, email.message.Message):
+                    email.generator.BytesGenerator(f, policy=email.policy.SMTP).flatten(message)
+                elif isinstance(message, (bytes, bytearray)):
+                    f.write(message)
+                else:
+                    for chunk in message:
+                        f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._db_lock, self._db:
+                self._db.execute('INSERT INTO messages (created, sender, recipients, path, tag, next_attempt, event_time) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (time.time(), sender, json.dumps(list(recipients)), path, tag, time.time(), event_time))
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def pending(self):
+        with self._db_lock:
+            return self._db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def _claim(self):
+        """Lease the next due message to the calling worker, or return the seconds until one is due."""
+        now = time.time()
+        with self._db_lock, self._db:
+            row = self._db.execute('SELECT id, sender, recipients, path, tag, attempts, next_attempt, event_time FROM messages '
+                                   'ORDER BY next_attempt LIMIT 1').fetchone()
+            if row is None:
+                return None, 60
+            if row[6] > now:
+                return None, row[6] - now
+            self._db.execute('UPDATE messages SET next_attempt = ? WHERE id = ?', (now + LEASE_SECONDS, row[0]))
+        return row, 0
+
+    def _throttle(self):
+        if not self.min_interval:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_send - now
+            self._next_send = max(now, self._next_send) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _deliver(self, row):
+        message_id, sender, recipients, path, tag, attempts, _, event_time = row
+        recipients = json.loads(recipients)
+        self._throttle()
+        try:
+            with SMTP_SESSION_SECONDS.time():
+                refused = self.smtp_pool.send_stream(sender, recipients, iter_file(path))
+        except Exception as e:
+            self._failed(row, e)
+            return
+        MAIL_SENT.inc()
+        if event_time:
+            ALERT_LATENCY_SECONDS.observe(time.time() - event_time)
+        if refused:
+            logging.warning(f"Spooled message {message_id} was refused for {', '.join(refused)}")
+        with self._db_lock, self._db:
+            self._db.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+        os.remove(path)
+        logging.debug(f"Spooled message {message_id} sent after {attempts + 1} attempt(s)")
+        if self.on_sent:
+            try:
+                self.on_sent(tag)
+            except Exception as e:
+                logging.error(f"Post-send hook failed for spooled message {message_id}. Error: {e}")
+
+    def _failed(self, row, error):
+        message_id, sender, recipients, path, tag, attempts = row[:6]
+        attempts += 1
+        if is_permanent(error) or attempts >= self.max_attempts:
+            MAIL_FAILURES.inc(outcome='dead_letter')
+            logging.error(f"Giving up on spooled message {message_id} after {attempts} attempt(s). Error: {error}")
+            dead_path = os.path.join(self.dead_dir, os.path.basename(path))
+            shutil.move(path, dead_path)
+            with open(f"{dead_path}.json", 'w') as f:
+                json.dump({'sender': sender, 'recipients': json.loads(recipients), 'tag': tag,
+                           'attempts': attempts, 'error': str(error), 'failed_at': time.time()}, f)
+            with self._db_lock, self._db:
+                self._db.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+            return
+
+        MAIL_FAILURES.inc(outcome='retry')
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max) * random.uniform(0.8, 1.2)
+        logging.warning(f"Failed to send spooled message {message_id} (attempt {attempts}), "
+                        f"retrying in {delay:.0f} seconds. Error: {error}")
+        with self._db_lock, self._db:
+            self._db.execute('UPDATE messages SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?',
+                             (attempts, time.time() + delay, str(error), message_id))
+
+    def _worker(self):
+        while True:
+            try:
+                row, wait = self._claim()
+            except Exception as e:
+                logging.error(f"Failed to read the mail spool. Error: {e}")
+                row, wait = None, 5
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=min(wait, 60))
+                continue
+            try:
+                self._deliver(row)
+            except Exception as e:
+                logging.error(f"Failed to process spooled message {row[0]}. Error: {e}")
+
+    def start(self):
+        """Start the sender threads; a spool shared by several services is only started once."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"spool-sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.debug(f"Started {self.workers} spool sender(s) for {self.directory} ({self.pending()} message(s) pending)")
@@ -0,0 +1,150 @@
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Largest clip attached as-is. Base64 grows the payload by a third, so 18 MB stays under Gmail's 25 MB limit.
+CLIP_MAX_BYTES = int(os.getenv('CLIP_MAX_BYTES', 18 * 1024 * 1024))
+CLIP_OVERSIZE_STRATEGY = os.getenv('CLIP_OVERSIZE_STRATEGY', 'transcode').lower()  # transcode, trim, split or link
+CLIP_TRANSCODE_HEIGHT = int(os.getenv('CLIP_TRANSCODE_HEIGHT', 480))
+CLIP_TRANSCODE_CRF = int(os.getenv('CLIP_TRANSCODE_CRF', 30))
+CLIP_TRIM_BEFORE = float(os.getenv('CLIP_TRIM_BEFORE', 5))  # seconds kept before the event starts
+CLIP_TRIM_AFTER = float(os.getenv('CLIP_TRIM_AFTER', 20))  # seconds kept after the event starts
+CLIP_LINK_BASE_URL = os.getenv('CLIP_LINK_BASE_URL')  # externally reachable Frigate URL for links
+CLIP_SPOOL_MEMORY = int(os.getenv('CLIP_SPOOL_MEMORY', 1024 * 1024))  # bytes kept in memory before spilling to a temp file
+
+FFMPEG = shutil.which('ffmpeg')
+FFPROBE = shutil.which('ffprobe')
+
+
+class ClipDelivery:
+    """What to send for one clip request: one or more open clip files, or a link."""
+
+    def __init__(self, strategy, files=None, link=None):
+        self.strategy = strategy
+        self.files = files or []
+        self.link = link
+
+    def close(self):
+        for fileobj in self.files:
+            fileobj.close()
+
+
+def transcode(event_id, media, source, workdir):
+    if not FFMPEG:
+        logging.warning("ffmpeg is not installed, cannot transcode oversized clip")
+        return None
+    source = source or media.clip(event_id, workdir)
+    target = os.path.join(workdir, 'clip_small.mp4')
+    subprocess.run([FFMPEG, '-nostdin', '-loglevel', 'error', '-y', '-i', source,
+                    '-vf', f'scale=-2:{CLIP_TRANSCODE_HEIGHT}', '-c:v', 'libx264', '-preset', 'veryfast',
+                    '-crf', str(CLIP_TRANSCODE_CRF), '-c:a', 'aac', '-b:a', '64k', '-movflags', '+faststart',
+                    target], check=True)
+    size = os.path.getsize(target)
+    if size > CLIP_MAX_BYTES:
+        logging.warning(f"Transcoded clip for event {event_id} is still {size} bytes")
+        return None
+    return ClipDelivery('transcode', [open(target, 'rb')])
+
+
+def trim(event_id, media, source, workdir):
+    # Ask Frigate for just the window around the event instead of cutting the full clip locally
+    event = media.get(f"/api/events/{event_id}").json()
+    start = event['start_time'] - CLIP_TRIM_BEFORE
+    end = event['start_time'] + CLIP_TRIM_AFTER
+    if event.get('end_time'):
+        end = min(end, event['end_time'])
+    window_path = f"/api/{event['camera']}/start/{start:.0f}/end/{end:.0f}/clip.mp4"
+    target = media.download_to_path(window_path, os.path.join(workdir, 'clip_trim.mp4'))
+    size = os.path.getsize(target)
+    if size > CLIP_MAX_BYTES:
+        logging.warning(f"Trimmed clip for event {event_id} is still {size} bytes")
+        return None
+    return ClipDelivery('trim', [open(target, 'rb')])
+
+
+def split(event_id, media, source, workdir):
+    if not FFMPEG or not FFPROBE:
+        logging.warning("ffmpeg/ffprobe are not installed, cannot split oversized clip")
+        return None
+    source = source or media.clip(event_id, workdir)
+    probe = subprocess.run([FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', source],
+                           check=True, capture_output=True, text=True)
+    duration = float(probe.stdout.strip())
+    # Cuts land on keyframes, so aim below the limit to leave room for uneven parts
+    parts = math.ceil(os.path.getsize(source) / (CLIP_MAX_BYTES * 0.8))
+    subprocess.run([FFMPEG, '-nostdin', '-loglevel', 'error', '-y', '-i', source, '-map', '0', '-c', 'copy',
+                    '-f', 'segment', '-segment_time', f'{duration / parts:.2f}', '-reset_timestamps', '1',
+                    os.path.join(workdir, 'part%03d.mp4')], check=True)
+    paths = sorted(os.path.join(workdir, name) for name in os.listdir(workdir) if name.startswith('part'))
+    oversized = [path for path in paths if os.path.getsize(path) > CLIP_MAX_BYTES]
+    if not paths or oversized:
+        logging.warning(f"Could not split clip for event {event_id} into parts under {CLIP_MAX_BYTES} bytes")
+        return None
+    return ClipDelivery('split', [open(path, 'rb') for path in paths])
+
+
+def link(event_id, media, source, workdir):
+    base_url = CLIP_LINK_BASE_URL.rstrip('/') if CLIP_LINK_BASE_URL else media.frigate_url
+    return ClipDelivery('link', link=f"{base_url}/api/events/{event_id}/clip.mp4")
+
+
+STRATEGIES = {
+    'transcode': transcode,
+    'trim': trim,
+    'split': split,
+    'link': link,
+}
+
+
+def prepare_clip(event_id, media, workdir):
+    """Decide how a clip gets delivered, checking its size before downloading it.
+
+    A clip already in the media cache (prefetched when its event ended) is used from
+    disk. Clips within CLIP_MAX_BYTES are attached unchanged. Larger ones go through
+    CLIP_OVERSIZE_STRATEGY, falling back to a link when that strategy is unavailable
+    or cannot get the clip under the limit.
+    """
+    started = time.monotonic()
+
+    source = media.cached_clip(event_id)
+    if source:
+        size = os.path.getsize(source)
+        logging.debug(f"Clip for event {event_id} found in the media cache")
+    else:
+        size = media.head_size(f"/api/events/{event_id}/clip.mp4")
+        if size is None or (media.cache is not None and size <= CLIP_MAX_BYTES):
+            # Download straight into the cache when there is one, so the next request for it is local
+            source = media.clip(event_id, workdir)
+            size = os.path.getsize(source)
+
+    if size <= CLIP_MAX_BYTES:
+        if source:
+            clip_file = open(source, 'rb')
+        else:
+            clip_file = tempfile.SpooledTemporaryFile(max_size=CLIP_SPOOL_MEMORY)
+            try:
+                media.download(f"/api/events/{event_id}/clip.mp4", clip_file)
+            except Exception:
+                clip_file.close()
+                raise
+        logging.info(f"Clip for event {event_id} is {size} bytes, attaching as-is "
+                     f"({time.monotonic() - started:.2f}s)")
+        return ClipDelivery('attach', [clip_file])
+
+    strategy = CLIP_OVERSIZE_STRATEGY if CLIP_OVERSIZE_STRATEGY in STRATEGIES else 'link'
+    logging.info(f"Clip for event {event_id} is {size} bytes, over the {CLIP_MAX_BYTES} byte limit; trying {strategy}")
+    try:
+        delivery = STRATEGIES[strategy](event_id, media, source, workdir)
+    except Exception as e:
+        logging.error(f"Clip {strategy} failed for event {event_id}. Error: {e}")
+        delivery = None
+    if delivery is None:
+        delivery = link(event_id, media, source, workdir)
+
+    logging.info(f"Clip for event {event_id} delivered by {delivery.strategy} "
+                 f"({len(delivery.files)} file(s)) in {time.monotonic() - started:.2f}s")
+    return delivery
@@ -1,14 +1,27 @@
 import imaplib
+import json
+import re
+import select
+import ssl
 import email
 from email.header import decode_header
 import os
-import requests
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 import logging
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import make_msgid
+
+from clip_delivery import ClipDelivery, prepare_clip
+from common.clip_token import CLIP_REQUEST_SUBJECT, CLIP_TOKEN_SECRET, CLIP_TOKEN_TTL, verify_token
+from common.media import MediaFetcher
+from common.metrics import Counter, Gauge, Histogram, start_http_server, timed
+from common.mime_stream import attachment_part, iter_message
+from common.smtp_pool import SMTPPool
+from common.spool import MailSpool
 
 # Set up logging
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
@@ -19,64 +32,338 @@ EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
 EMAIL_RECIPIENT = os.getenv('EMAIL_RECIPIENT')
 
+# Authenticated SMTP sessions reused across clip emails
+smtp_pool = SMTPPool.from_env(EMAIL_ADDRESS, EMAIL_PASSWORD)
+
 # Frigate settings
 FRIGATE_HOST = os.getenv('FRIGATE_HOST')
 FRIGATE_PORT = os.getenv('FRIGATE_PORT')
 
+# Pooled Frigate session and the on-disk media cache (shared with mqtt-to-email, which prefetches clips into it)
+media = MediaFetcher.from_env(f"http://{FRIGATE_HOST}:{FRIGATE_PORT}")
+
+# Clips prepared and queued at the same time when several requests are pending
+CLIP_WORKERS = int(os.getenv('CLIP_WORKERS', 3))
+clip_workers = ThreadPoolExecutor(max_workers=max(1, CLIP_WORKERS), thread_name_prefix='clip-worker')
+
+# Metrics, served on METRICS_PORT
+CLIP_REQUESTS = Counter('clip_requests_total', 'Clip request emails, by outcome', ['outcome'])
+CLIP_EMAILS_QUEUED = Counter('clip_emails_queued_total', 'Clip emails written to the outgoing spool, by delivery', ['strategy'])
+CLIP_FAILURES = Counter('clip_failures_total', 'Clip requests that failed, by stage', ['stage'])
+IMAP_RECONNECTS = Counter('imap_reconnects_total', 'IMAP sessions dropped after an error')
+IMAP_CYCLE_SECONDS = Histogram('imap_cycle_seconds', 'Time for one inbox pass, answering requests and cleaning up sent copies')
+SEND_CLIP_SECONDS = Histogram('send_clip_email_seconds', 'Time to prepare one requested clip and write it to the spool')
+
 # IMAP settings
-IMAP_SERVER = 'imap.gmail.com'
+IMAP_SERVER = os.getenv('IMAP_SERVER', 'imap.gmail.com')
+IMAP_PORT = int(os.getenv('IMAP_PORT', 993))
+IMAP_SSL = os.getenv('IMAP_SSL', 'true').lower() == 'true'
+IMAP_IDLE_TIMEOUT = float(os.getenv('IMAP_IDLE_TIMEOUT', 29 * 60))  # servers may drop an IDLE after 30 minutes
+IMAP_POLL_INTERVAL = float(os.getenv('IMAP_POLL_INTERVAL', 5))  # NOOP polling when the server lacks IDLE
+IMAP_BACKOFF_MAX = float(os.getenv('IMAP_BACKOFF_MAX', 300))
+IMAP_STATE_FILE = os.getenv('IMAP_STATE_FILE', 'data/email_listener_state.json')
+IMAP_SENT_FOLDER = os.getenv('IMAP_SENT_FOLDER', '"[Gmail]/Sent Mail"')  # Gmail's "Sent Mail" folder
+SENT_DELETE_TIMEOUT = 3600  # seconds to keep looking for a sent copy that has not shown up in the sent folder
 
-def check_incoming_emails():
+# Highest inbox UID already looked at, persisted across restarts
+uid_state = {}
+
+# Message-IDs of delivered clip emails whose sent copy is still to be deleted, added by the spool senders
+sent_to_delete = {}
+sent_to_delete_lock = threading.Lock()
+# A byte is written here when there is something to delete, which ends an IMAP IDLE early
+wakeup_read, wakeup_write = os.pipe()
+os.set_blocking(wakeup_write, False)
+Gauge('sent_copies_pending_delete', 'Delivered clip emails whose sent copy is still to be deleted', lambda: len(sent_to_delete))
+
+def connect_imap():
+    if IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
+    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+    # Servers often advertise more (IDLE included) once authenticated
+    status, data = mail.capability()
+    if status == 'OK' and data and data[-1]:
+        mail.capabilities = tuple(data[-1].decode().upper().split())
+    mail.select('inbox')
+    sync_uid_state(mail)
+    return mail
+
+def wait_for_idle(mail, timeout):
+    """Block in IMAP IDLE until the server pushes an update or `timeout` seconds pass.
+
+    imaplib has no IDLE support before Python 3.14, so the command is driven by hand.
+    Any untagged response ends the IDLE; the caller re-scans and idles again.
+    """
+    tag = mail._new_tag()
+    mail.tagged_commands.pop(tag, None)
+    mail.send(tag + b' IDLE\r\n')
+    line = mail.readline()
+    if not line.startswith(b'+'):
+        raise mail.abort(f"IDLE rejected: {line!r}")
+
+    sock = mail.socket()
+    pushed = False
+    pending = isinstance(sock, ssl.SSLSocket) and sock.pending()
+    ready = [sock] if pending else select.select([sock, wakeup_read], [], [], timeout)[0]
+    if wakeup_read in ready:
+        os.read(wakeup_read, 1024)
+    if sock in ready:
+        line = mail.readline()
+        if not line:
+            raise mail.abort("Connection closed during IDLE")
+        logging.debug(f"IDLE update: {line!r}")
+        pushed = True
+
+    mail.send(b'DONE\r\n')
     while True:
+        line = mail.readline()
+        if not line:
+            raise mail.abort("Connection closed while ending IDLE")
+        if line.startswith(tag):
+            if not line.startswith(tag + b' OK'):
+                raise mail.error(f"IDLE failed: {line!r}")
+            return pushed
+
+def has_new_mail(mail):
+    """Whether the inbox has mail past the high-water mark, asked again after the untagged responses are cleared."""
+    last_uid = uid_state.get('last_uid')
+    if last_uid is None:
+        # A UIDVALIDITY change reset the mark; the next scan starts over
+        return True
+    status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+    if status != 'OK':
+        raise mail.error(f"UID SEARCH failed with status {status}")
+    # "n:*" always matches the newest message, even when its UID is below n
+    return any(int(uid) > last_uid for uid in data[0].split())
+
+def wait_for_poll(mail, interval):
+    time.sleep(interval)
+    status, _ = mail.noop()
+    if status != 'OK':
+        raise mail.abort(f"NOOP failed with status {status}")
+    return True
+
+def load_uid_state():
+    try:
+        with open(IMAP_STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to load IMAP state from {IMAP_STATE_FILE}, rescanning mailbox. Error: {e}")
+        return {}
+
+def save_uid_state():
+    try:
+        state_dir = os.path.dirname(IMAP_STATE_FILE)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        tmp_path = f"{IMAP_STATE_FILE}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(uid_state, f)
+        os.replace(tmp_path, IMAP_STATE_FILE)
+    except OSError as e:
+        logging.error(f"Failed to save IMAP state to {IMAP_STATE_FILE}. Error: {e}")
+
+def mailbox_status(mail, name):
+    # SELECT reports UIDVALIDITY and UIDNEXT as untagged OK responses
+    values = mail.untagged_responses.get(name)
+    if not values:
+        return None
+    try:
+        return int(values[-1])
+    except ValueError:
+        return None
+
+def sync_uid_state(mail):
+    uidvalidity = mailbox_status(mail, 'UIDVALIDITY')
+    if uid_state.get('uidvalidity') != uidvalidity:
+        if uid_state:
+            logging.info(f"Mailbox UIDVALIDITY changed to {uidvalidity}, rescanning")
+        # Used clip tokens stay used across a mailbox rescan
+        used_tokens = uid_state.get('used_tokens', {})
+        uid_state.clear()
+        uid_state['used_tokens'] = used_tokens
+        uid_state['uidvalidity'] = uidvalidity
+        uid_state['last_uid'] = None
+        uid_state['uidnext'] = mailbox_status(mail, 'UIDNEXT')
+
+def initial_scan(mail):
+    # No high-water mark yet: pick up requests already waiting, then start counting from the newest UID
+    status, data = mail.uid('SEARCH', None, '(UNSEEN SUBJECT "Send Clip")')
+    uids = [int(u) for u in data[0].split()]
+    uidnext = uid_state.pop('uidnext', None)
+    if uidnext:
+        high_water = uidnext - 1
+    else:
+        status, data = mail.uid('SEARCH', None, 'ALL')
+        all_uids = data[0].split()
+        high_water = int(all_uids[-1]) if all_uids else 0
+    return uids, max([high_water] + uids)
+
+def fetch_subjects(mail, uids):
+    status, data = mail.uid('FETCH', ','.join(str(u) for u in uids), '(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+    subjects = {}
+    for response in data:
+        if isinstance(response, tuple):
+            match = re.search(rb'UID (\d+)', response[0])
+            if not match:
+                continue
+            headers = email.message_from_bytes(response[1])
+            subject = decode_header(headers['Subject'] or '')[0][0]
+            if isinstance(subject, bytes):
+                subject = subject.decode()
+            subjects[int(match.group(1))] = subject
+    return subjects
+
+def process_inbox(mail):
+    last_uid = uid_state.get('last_uid')
+    if last_uid is None:
+        uids, high_water = initial_scan(mail)
+    else:
+        # Only look past the high-water mark, so the cost does not grow with the mailbox
+        logging.debug(f"Searching for emails after UID {last_uid}")
+        status, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        # "n:*" always matches the newest message, even when its UID is below n
+        uids = [u for u in (int(u) for u in data[0].split()) if u > last_uid]
+        high_water = max([last_uid] + uids)
+    logging.debug(f"Found {len(uids)} new email(s)")
+
+    subjects = fetch_subjects(mail, uids) if uids else {}
+    requested_at = time.time()
+    # event ID -> UIDs of the emails asking for it
+    requests = {}
+    # Tokens first used in this pass -> their event ID; the same link clicked twice is a duplicate, not a replay
+    batch_tokens = {}
+    try:
+        for uid in sorted(subjects):
+            subject = subjects[uid]
+            logging.debug(f"Email subject: {subject}")
+            event_id = None
+            if CLIP_TOKEN_SECRET:
+                # Signed requests are matched and verified from the subject alone
+                if subject.startswith(CLIP_REQUEST_SUBJECT):
+                    event_id = verify_token_request(uid, subject, batch_tokens)
+            elif subject == CLIP_REQUEST_SUBJECT:
+                event_id = read_body_request(mail, uid)
+            if event_id:
+                CLIP_REQUESTS.inc(outcome='duplicate' if event_id in requests else 'accepted')
+                requests.setdefault(event_id, []).append(uid)
+    finally:
+        # Requests already read are answered even if the scan broke off
+        queued = fulfil_clip_requests(requests, requested_at)
+        # A token is only used up once its clip is on its way, so a failed request can be made again
+        mark_tokens_used(signature for signature, event_id in batch_tokens.items() if event_id in queued)
+        # Answered requests are removed together at the end of the pass
+        delete_emails(mail, [uid for request_uids in requests.values() for uid in request_uids])
+
+    uid_state['last_uid'] = high_water
+    save_uid_state()
+
+def verify_token_request(uid, subject, batch_tokens):
+    try:
+        event_id, signature = verify_token(subject, CLIP_TOKEN_SECRET, CLIP_TOKEN_TTL)
+    except ValueError as e:
+        logging.warning(f"Rejected clip request in email {uid}: {e}")
+        CLIP_REQUESTS.inc(outcome='rejected')
+        return None
+
+    # Each token is honoured once; it is remembered until it would have expired anyway
+    now = time.time()
+    used_tokens = {sig: expires for sig, expires in uid_state.get('used_tokens', {}).items() if expires > now}
+    uid_state['used_tokens'] = used_tokens
+    if signature in batch_tokens:
+        return event_id
+    if signature in used_tokens:
+        logging.warning(f"Rejected replayed clip request for event ID {event_id} in email {uid}")
+        CLIP_REQUESTS.inc(outcome='replayed')
+        return None
+    batch_tokens[signature] = event_id
+
+    logging.debug(f"Verified clip request for event ID {event_id}")
+    return event_id
+
+def mark_tokens_used(signatures):
+    expires = time.time() + CLIP_TOKEN_TTL
+    used_tokens = uid_state.setdefault('used_tokens', {})
+    for signature in signatures:
+        used_tokens[signature] = expires
+
+def read_body_request(mail, uid):
+    res, msg_data = mail.uid('FETCH', str(uid), '(RFC822)')
+    for response in msg_data:
+        if isinstance(response, tuple):
+            msg = email.message_from_bytes(response[1])
+            body = extract_body(msg)
+            logging.debug(f"Email body: {body}")
+
+            event_id = extract_event_id(body)
+            logging.debug(f"Extracted event ID: {event_id}")
+
+            if event_id:
+                return event_id
+            logging.debug("Event ID not found in email body")
+    CLIP_REQUESTS.inc(outcome='rejected')
+    return None
+
+def fulfil_clip_requests(requests, requested_at=None):
+    """Send one clip per requested event, up to CLIP_WORKERS at a time, and wait until all are queued.
+
+    Returns the event IDs whose clip email was queued.
+    """
+    if not requests:
+        return set()
+    duplicates = sum(len(request_uids) - 1 for request_uids in requests.values())
+    logging.info(f"Fulfilling {len(requests)} clip request(s)"
+                 + (f", {duplicates} duplicate request(s) coalesced" if duplicates else ""))
+    started = time.monotonic()
+    futures = [clip_workers.submit(send_clip_email, event_id, requested_at) for event_id in requests]
+    queued = set()
+    for event_id, future in zip(requests, futures):
         try:
-            mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-            mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            mail.select('inbox')
+            if future.result():
+                queued.add(event_id)
+        except Exception as e:
+            logging.error(f"Failed to send clip for event ID {event_id}. Error: {e}")
+    logging.debug(f"Clip request(s) fulfilled in {time.monotonic() - started:.2f}s")
+    return queued
 
-            logging.debug("Started checking for new emails...")
+def check_incoming_emails():
+    backoff = 1
+    while True:
+        mail = None
+        try:
+            mail = connect_imap()
+            supports_idle = 'IDLE' in mail.capabilities
+            logging.debug(f"Started checking for new emails using {'IDLE' if supports_idle else 'NOOP polling'}...")
 
+            # One session for as long as it stays healthy; new mail wakes us up instead of a fixed sleep
             while True:
-                logging.debug("Performing search for unread emails with subject 'Send Clip'")
-                status, messages = mail.search(None, '(UNSEEN SUBJECT "Send Clip")')
-                logging.debug(f"Search status: {status}")
-                logging.debug(f"Search response: {messages}")
-
-                email_ids = messages[0].split()
-                logging.debug(f"Found {len(email_ids)} new email(s)")
-
-                for e_id in email_ids:
-                    res, msg_data = mail.fetch(e_id, '(RFC822)')
-                    for response in msg_data:
-                        if isinstance(response, tuple):
-                            msg = email.message_from_bytes(response[1])
-                            subject = decode_header(msg['Subject'])[0][0]
-                            if isinstance(subject, bytes):
-                                subject = subject.decode()
-                            logging.debug(f"Email subject: {subject}")
-                            
-                            if subject == 'Send Clip':
-                                body = extract_body(msg)
-                                logging.debug(f"Email body: {body}")
-                                
-                                event_id = extract_event_id(body)
-                                logging.debug(f"Extracted event ID: {event_id}")
-                                
-                                if event_id:
-                                    send_clip_email(event_id)
-                                    delete_email(mail, e_id)
-                                else:
-                                    logging.debug("Event ID not found in email body")
-
-                # Reconnect after processing a batch of emails to avoid connection issues
-                mail.close()
-                mail.logout()
-                time.sleep(15)  # Check for new emails every 15 seconds
-                mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-                mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-                mail.select('inbox')
+                with IMAP_CYCLE_SECONDS.time():
+                    process_inbox(mail)
+                    delete_sent_emails(mail)
+                backoff = 1
+                # Responses already handled by the scan would otherwise pile up on a long-lived session
+                mail.untagged_responses.clear()
+                if supports_idle:
+                    if has_new_mail(mail):
+                        # Arrived during the scan; its EXISTS was among the responses just cleared, so IDLE would not report it
+                        continue
+                    wait_for_idle(mail, IMAP_IDLE_TIMEOUT)
+                else:
+                    wait_for_poll(mail, IMAP_POLL_INTERVAL)
         except Exception as e:
-            logging.error(f"An error occurred: {e}")
-            time.sleep(15)  # Wait before attempting to reconnect
+            logging.error(f"An error occurred: {e}. Reconnecting in {backoff} seconds")
+            IMAP_RECONNECTS.inc()
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, IMAP_BACKOFF_MAX)
 
 def extract_body(msg):
     logging.debug("Extracting body from email")
@@ -100,7 +387,6 @@ def extract_event_id(body):
     for line in lines:
         if 'event ID' in line:
             # Extract the event ID using regex to ensure no extra text is included
-            import re
             match = re.search(r'event ID ([\w.-]+)', line)
             if match:
                 event_id = match.group(1)
@@ -108,72 +394,125 @@ def extract_event_id(body):
                 return event_id
     return None
 
-def send_clip_email(event_id):
-    clip_url = f"http://{FRIGATE_HOST}:{FRIGATE_PORT}/api/events/{event_id}/clip.mp4"
-    subject = f"Frigate Clip: Event {event_id}"
-    body = f"Here is the clip for the event ID {event_id}."
-
+def build_clip_message(subject, body):
     msg = MIMEMultipart()
     msg['From'] = EMAIL_ADDRESS
     msg['To'] = EMAIL_RECIPIENT
     msg['Subject'] = subject
+    # Known up front, so the sent copy can be found again without searching by subject
+    msg['Message-ID'] = make_msgid(domain=EMAIL_ADDRESS.rpartition('@')[2] or None)
 
     msg.attach(MIMEText(body, 'plain'))
+    return msg
 
-    # Attach clip
-    try:
-        logging.debug(f"Downloading clip from {clip_url}")
-        response = requests.get(clip_url)
-        response.raise_for_status()
-        clip = response.content
-        logging.debug("Clip downloaded successfully")
-        clip_attachment = MIMEApplication(clip, Name="clip.mp4")
-        clip_attachment.add_header('Content-Disposition', 'attachment; filename="clip.mp4"')
-        msg.attach(clip_attachment)
-    except Exception as e:
-        logging.error(f"Failed to download clip. Error: {e}")
+@timed(SEND_CLIP_SECONDS)
+def send_clip_email(event_id, requested_at=None):
+    """Queue the clip, or a link to it, for `event_id`; returns whether that worked."""
+    subject = f"Frigate Clip: Event {event_id}"
+    body = f"Here is the clip for the event ID {event_id}."
 
-    try:
-        logging.debug("Attempting to send email with clip...")
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, EMAIL_RECIPIENT, text)
-        server.quit()
-        logging.debug("Email sent successfully!")
-
-        # Delete the sent email from the sent items
-        delete_sent_email(subject)
-    except Exception as e:
-        logging.error(f"Failed to send email. Error: {e}")
+    with tempfile.TemporaryDirectory() as workdir:
+        # Check the clip size first, then attach, shrink, split or link it
+        try:
+            delivery = prepare_clip(event_id, media, workdir)
+        except Exception as e:
+            logging.error(f"Failed to download clip. Error: {e}")
+            CLIP_FAILURES.inc(stage='download')
+            delivery = ClipDelivery('none')
+
+        try:
+            if delivery.link:
+                body = f"The clip for the event ID {event_id} is too large to attach. Download it here: {delivery.link}"
+            parts = delivery.files or [None]
+            for index, clip_file in enumerate(parts, start=1):
+                part_subject = subject if len(parts) == 1 else f"{subject} (part {index}/{len(parts)})"
+                msg = build_clip_message(part_subject, body)
+                attachments = [(attachment_part("clip.mp4"), clip_file)] if clip_file else []
+
+                logging.debug("Queueing email with clip...")
+                # The clip is base64-encoded once, a chunk at a time, into the spool; retries resend that file.
+                # The sent copy is deleted from the sent items once the spool has delivered it.
+                spool.enqueue(EMAIL_ADDRESS, [EMAIL_RECIPIENT], iter_message(msg, attachments),
+                              tag=msg['Message-ID'], event_time=requested_at)
+                CLIP_EMAILS_QUEUED.inc(strategy=delivery.strategy)
+                logging.debug("Email queued for sending")
+        except Exception as e:
+            CLIP_FAILURES.inc(stage='spool')
+            logging.error(f"Failed to queue email. Error: {e}")
+            return False
+        finally:
+            delivery.close()
+    return delivery.strategy != 'none'
 
-def delete_sent_email(subject):
+def delete_emails(mail, uids):
+    """Flag and expunge `uids` in the selected mailbox with one UID STORE and one UID EXPUNGE."""
+    if not uids:
+        return
+    uid_set = ','.join(str(uid) for uid in sorted(uids))
     try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        mail.select('"[Gmail]/Sent Mail"')  # Gmail's "Sent Mail" folder
-        status, messages = mail.search(None, f'(SUBJECT "{subject}")')
-        logging.debug(f"Search status: {status}")
-        logging.debug(f"Search response: {messages}")
-
-        email_ids = messages[0].split()
-        for e_id in email_ids:
-            mail.store(e_id, '+FLAGS', '\\Deleted')
-        mail.expunge()
-        mail.close()
-        mail.logout()
-        logging.debug(f"Deleted sent email with subject: {subject}")
+        mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if 'UIDPLUS' in mail.capabilities:
+            # Leaves alone anything another client has flagged for deletion
+            mail.uid('EXPUNGE', uid_set)
+        else:
+            mail.expunge()
+        logging.debug(f"Deleted email(s) with UID {uid_set}")
     except Exception as e:
-        logging.error(f"Failed to delete sent email. Error: {e}")
+        logging.error(f"Failed to delete email(s) with UID {uid_set}. Error: {e}")
+
+def delete_sent_emails(mail):
+    """Delete the sent copies of delivered clip emails, found by Message-ID, on the listener's own session."""
+    with sent_to_delete_lock:
+        pending = dict(sent_to_delete)
+    if not pending:
+        return
 
-def delete_email(mail, e_id):
+    found = []
+    uids = []
     try:
-        mail.store(e_id, '+FLAGS', '\\Deleted')
-        mail.expunge()
-        logging.debug(f"Email with ID {e_id} deleted successfully")
+        status, data = mail.select(IMAP_SENT_FOLDER)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SELECT {IMAP_SENT_FOLDER} failed: {data}")
+        for message_id in pending:
+            status, data = mail.uid('SEARCH', None, f'HEADER Message-ID "{message_id}"')
+            matches = data[0].split() if status == 'OK' and data and data[0] else []
+            if matches:
+                found.append(message_id)
+                uids.extend(int(uid) for uid in matches)
+        delete_emails(mail, uids)
     except Exception as e:
-        logging.error(f"Failed to delete email with ID {e_id}. Error: {e}")
+        # A missing sent folder must not take the listener's session down with it
+        logging.error(f"Failed to delete sent emails in {IMAP_SENT_FOLDER}. Error: {e}")
+    finally:
+        mail.select('inbox')
+        sync_uid_state(mail)
+
+    # Also after a failed search, so entries that can never be found do not pile up
+    now = time.time()
+    with sent_to_delete_lock:
+        for message_id, queued_at in pending.items():
+            if message_id in found:
+                sent_to_delete.pop(message_id, None)
+            elif now - queued_at > SENT_DELETE_TIMEOUT:
+                logging.warning(f"Sent copy of {message_id} not found in {IMAP_SENT_FOLDER}, giving up")
+                sent_to_delete.pop(message_id, None)
+    logging.debug(f"Deleted {len(found)} sent email(s), {len(pending) - len(found)} not in the sent folder yet")
+
+def on_clip_sent(message_id):
+    # Runs on a spool sender thread; the IMAP session belongs to the listener loop, so hand it over
+    if message_id:
+        with sent_to_delete_lock:
+            sent_to_delete[message_id] = time.time()
+        try:
+            os.write(wakeup_write, b'\0')
+        except BlockingIOError:
+            pass  # a wakeup is already pending
+
+# Outgoing clips are written to an on-disk spool first and retried from there
+spool = MailSpool.from_env(smtp_pool, on_sent=on_clip_sent)
 
 if __name__ == "__main__":
+    uid_state.update(load_uid_state())
+    start_http_server()
+    spool.start()
     check_incoming_emails()
@@ -0,0 +1,183 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a background write waits, so the rows of a burst of new events go in one transaction
+WRITE_DELAY = 1
+
+
+class DedupCache:
+    """Remembers event IDs already handled, evicting by age (`ttl`) and by count (`max_size`).
+
+    Every sighting of an event refreshes it, so an object Frigate keeps tracking stays
+    deduplicated for as long as updates keep coming. With a `path`, entries are also
+    kept in a small SQLite file and reloaded on start, so a restart does not resend
+    alerts for events that are still in progress. `seen()` runs on the MQTT network
+    thread and never touches the file: a background thread writes new entries in
+    batches within about a second, and refreshes are throttled, so the stored time may
+    lag the in-memory one by up to a tenth of `ttl`.
+
+    With `shared`, several processes (replicas behind a shared MQTT subscription) use the
+    one file: an unknown event ID is claimed with INSERT OR IGNORE, so exactly one of them
+    handles it, and rows are only removed once they are older than `ttl`. The file must be
+    on a local disk or volume; SQLite locking is not reliable over network filesystems.
+    A claim can wait on another replica's lock, so the caller makes it with `claim()`
+    from a worker.
+    """
+
+    def __init__(self, max_size=1000, ttl=3600, path=None, shared=False):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # event_id -> (last seen, last written to disk), least recently seen first
+        self._entries = OrderedDict()
+        self._db = None
+        # Serialises use of the connection, which may wait on another replica; never taken under _lock
+        self._db_lock = threading.Lock()
+        # event_id -> last seen, rows not yet written to the file (refreshes only, when shared)
+        self._writes = {}
+        # Event IDs evicted by count, whose rows are still to be deleted (never when shared)
+        self._deletes = set()
+        self._wakeup = threading.Event()
+        self.shared = bool(path) and shared
+        if path:
+            # Waits for another replica's write instead of failing with "database is locked"
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+            self._load()
+            threading.Thread(target=self._write, name='dedup-writer', daemon=True).start()
+
+    def _load(self):
+        now = time.time()
+        with self._db:
+            self._db.execute('DELETE FROM seen_events WHERE seen_at < ?', (now - self.ttl,))
+        rows = self._db.execute(
+            'SELECT event_id, seen_at FROM (SELECT event_id, seen_at FROM seen_events ORDER BY seen_at DESC LIMIT ?) '
+            'ORDER BY seen_at', (self.max_size,)).fetchall()
+        for event_id, seen_at in rows:
+            self._entries[event_id] = (seen_at, seen_at)
+        logging.debug(f"Loaded {len(rows)} recent event ID(s) for deduplication")
+
+    def _evict(self, now):
+        expired = []
+        while self._entries:
+            event_id, (seen_at, _) = next(iter(self._entries.items()))
+            if seen_at >= now - self.ttl and len(self._entries) <= self.max_size:
+                break
+            self._entries.popitem(last=False)
+            expired.append(event_id)
+        if expired:
+            self.evictions += len(expired)
+            # Other replicas may still need rows this one has no room for; the writer drops the expired ones
+            if self._db and not self.shared:
+                for event_id in expired:
+                    self._writes.pop(event_id, None)
+                self._deletes.update(expired)
+                self._wakeup.set()
+
+    def seen(self, event_id):
+        """Record a sighting of `event_id`; returns True if it was already known."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(event_id)
+            if entry is not None and entry[0] >= now - self.ttl:
+                self.hits += 1
+                persisted_at = entry[1]
+                if self._db and now - persisted_at > self.ttl / 10:
+                    self._writes[event_id] = now
+                    persisted_at = now
+                self._entries[event_id] = (now, persisted_at)
+                self._entries.move_to_end(event_id)
+                return True
+
+            self.misses += 1
+            self._entries[event_id] = (now, now)
+            self._entries.move_to_end(event_id)
+            if self._db and not self.shared:
+                self._deletes.discard(event_id)
+                self._writes[event_id] = now
+                self._wakeup.set()
+            self._evict(now)
+            return False
+
+    def claim(self, event_id):
+        """Take the event `seen()` just reported as new for this replica; False if another replica holds it.
+
+        Always True unless `shared`. Can wait on the shared file, so call it from a worker.
+        """
+        if not self.shared:
+            return True
+        claimed = self._claim(event_id)
+        if not claimed:
+            # Another replica got it first
+            with self._lock:
+                self.misses -= 1
+                self.hits += 1
+        return claimed
+
+    def claim_once(self, key):
+        """Like `claim`, for anything other than an event's first alert (a notification, a follow-up).
+
+        The key is only claimed in the shared file, not remembered in memory.
+        """
+        return not self.shared or self._claim(key)
+
+    def _claim(self, key):
+        now = time.time()
+        try:
+            with self._db_lock, self._db:
+                claimed = self._db.execute('INSERT OR IGNORE INTO seen_events (event_id, seen_at) VALUES (?, ?)',
+                                           (key, now)).rowcount
+                if not claimed:
+                    # A row nobody has refreshed within `ttl` is free to take again
+                    claimed = self._db.execute('UPDATE seen_events SET seen_at = ? WHERE event_id = ? AND seen_at < ?',
+                                               (now, key, now - self.ttl)).rowcount
+        except sqlite3.Error as e:
+            # A duplicate email is better than a lost one
+            logging.warning(f"Could not claim {key} in the shared dedup store, handling it here. Error: {e}")
+            return True
+        return claimed == 1
+
+    def _write(self):
+        expire_interval = min(60, max(1, self.ttl / 10))
+        expired_at = 0.0
+        while True:
+            self._wakeup.wait(expire_interval)
+            time.sleep(WRITE_DELAY)
+            with self._lock:
+                self._wakeup.clear()
+                writes, self._writes = self._writes, {}
+                deletes, self._deletes = self._deletes, set()
+            now = time.time()
+            expire = now - expired_at >= expire_interval
+            if not (writes or deletes or expire):
+                continue
+            try:
+                with self._db_lock, self._db:
+                    if self.shared:
+                        # Never moves another replica's newer refresh back
+                        self._db.executemany('UPDATE seen_events SET seen_at = ? WHERE event_id = ? AND seen_at < ?',
+                                             [(seen_at, event_id, seen_at) for event_id, seen_at in writes.items()])
+                    else:
+                        self._db.executemany('DELETE FROM seen_events WHERE event_id = ?', [(event_id,) for event_id in deletes])
+                        self._db.executemany('INSERT OR REPLACE INTO seen_events (event_id, seen_at) VALUES (?, ?)',
+                                             list(writes.items()))
+                    if expire:
+                        self._db.execute('DELETE FROM seen_events WHERE seen_at < ?', (now - self.ttl,))
+                expired_at = now if expire else expired_at
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write {len(writes) + len(deletes)} change(s) to the dedup store. Error: {e}")
+                with self._lock:
+                    for event_id, seen_at in writes.items():
+                        if event_id not in self._deletes:
+                            self._writes.setdefault(event_id, seen_at)
+                    self._deletes.update(deletes - set(self._writes))
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+
+class DigestBatcher:
+    """Collects events for up to `window` seconds and hands them to `send_batch` in one go.
+
+    Events are batched separately per recipient list. The window starts with the
+    first event of a batch, and a batch reaching `max_events` is sent straight away
+    instead of waiting for the window to close.
+    """
+
+    def __init__(self, window, max_events, send_batch):
+        self.window = window
+        self.max_events = max(1, max_events)
+        self.send_batch = send_batch
+        self._lock = threading.Lock()
+        # recipients -> pending events, and the timer that will flush them
+        self._events = {}
+        self._timers = {}
+
+    def add(self, event_id, camera_name, image, recipients, event_time=None):
+        key = tuple(recipients)
+        with self._lock:
+            events = self._events.setdefault(key, [])
+            events.append({'event_id': event_id, 'camera': camera_name, 'image': image, 'time': time.time(),
+                           'event_time': event_time})
+            if len(events) >= self.max_events:
+                batch = self._take(key)
+            else:
+                batch = None
+                if key not in self._timers:
+                    timer = threading.Timer(self.window, self.flush, args=(key,))
+                    timer.daemon = True
+                    self._timers[key] = timer
+                    timer.start()
+        if batch:
+            self._send(batch, key)
+
+    def _take(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        return self._events.pop(key, [])
+
+    def flush(self, key):
+        with self._lock:
+            batch = self._take(key)
+        if batch:
+            self._send(batch, key)
+
+    def _send(self, batch, recipients):
+        logging.debug(f"Sending digest of {len(batch)} event(s) to {', '.join(recipients)}")
+        try:
+            self.send_batch(batch, list(recipients))
+        except Exception as e:
+            logging.error(f"Failed to send digest of {len(batch)} event(s). Error: {e}")
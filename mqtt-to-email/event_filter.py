@@ -0,0 +1,79 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, only makes decoding faster
+    orjson = None
+
+
+def loads(payload):
+    """Decode a JSON payload, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def needles(values):
+    """Quoted JSON byte strings for `values`, or None if any cannot be matched byte for byte."""
+    quoted = []
+    for value in values:
+        if not value.isascii():
+            return None
+        quoted.append(json.dumps(value).encode())
+    return quoted
+
+
+class EventFilter:
+    """The camera, label, event type, zone and score filters compiled into one predicate.
+
+    quick_reject() looks for the quoted camera and label names in the raw payload, so
+    most unwanted messages are dropped without being decoded. It never drops a message
+    the full check would accept: if a name is missing from the bytes, it is missing
+    from the event too. reject_reason() then runs the exact checks on the decoded event.
+    """
+
+    def __init__(self, cameras, labels, event_types=None, zones=None, min_score=0.0):
+        self.cameras = None if not cameras or 'ALL' in cameras else frozenset(cameras)
+        self.labels = None if not labels or 'ALL' in labels else frozenset(labels)
+        self.event_types = frozenset(event_types) if event_types else None
+        self.zones = frozenset(zones) if zones else None
+        self.min_score = min_score
+
+        self._needle_groups = []
+        for values in (self.labels, self.cameras):
+            quoted = needles(values) if values is not None else None
+            if quoted:
+                self._needle_groups.append(quoted)
+
+        checks = []
+        if self.event_types is not None:
+            checks.append(lambda event, after: event.get('type') not in self.event_types
+                          and f"Event type '{event.get('type')}' is not in filter list '{sorted(self.event_types)}'")
+        if self.cameras is not None:
+            checks.append(lambda event, after: after['camera'] not in self.cameras
+                          and f"Camera '{after['camera']}' is not in filter list '{sorted(self.cameras)}'")
+        if self.labels is not None:
+            checks.append(lambda event, after: after['label'] not in self.labels
+                          and f"Event label '{after['label']}' does not match filter '{sorted(self.labels)}'")
+        if self.zones is not None:
+            checks.append(lambda event, after: self.zones.isdisjoint(after.get('entered_zones') or ())
+                          and f"Event zones {after.get('entered_zones')} are not in filter list '{sorted(self.zones)}'")
+        if self.min_score:
+            checks.append(lambda event, after: (after.get('top_score') or after.get('score') or 0) < self.min_score
+                          and f"Event score {after.get('top_score')} is below {self.min_score}")
+        self._checks = tuple(checks)
+
+    def quick_reject(self, payload):
+        for group in self._needle_groups:
+            if not any(needle in payload for needle in group):
+                return True
+        return False
+
+    def reject_reason(self, event):
+        """Why `event` is filtered out, or None if it passes."""
+        after = event['after']
+        for check in self._checks:
+            reason = check(event, after)
+            if reason:
+                return reason
+        return None
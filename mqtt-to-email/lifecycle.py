@@ -0,0 +1,152 @@
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+ALERT_MODES = ('first', 'best', 'early')
+
+
+class TrackedEvent:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.last_seen = 0.0
+        self.job = None
+        self.best_score = 0.0
+        self.has_snapshot = False
+        # Score of the snapshot sent, None until one is
+        self.sent_score = None
+        # Whether this replica won the claim for the first alert, None until the worker knows
+        self.claimed = None
+        self.followed_up = False
+
+
+class EventTracker:
+    """Follows each Frigate event through its new, update and end messages and decides when to alert on it.
+
+    In `best` mode an event is sent once: when its score reaches `send_score`, when
+    it ends, or `debounce` seconds after its first message, whichever comes first,
+    so the snapshot downloaded then is the best Frigate has. In `early` mode the
+    first message with a snapshot is sent straight away, and one follow-up goes out
+    if the score later rises by `followup_delta` or more, once `claimed()` reports
+    that this replica sent the first. Either way `send(job, followup)` is called
+    outside the lock. At most `max_events` events are tracked, and one not heard of
+    for `ttl` seconds is forgotten.
+    """
+
+    def __init__(self, mode, send, debounce=5, send_score=0, followup_delta=0.1, max_events=1000, ttl=600):
+        self.mode = mode
+        self.send = send
+        self.debounce = debounce
+        self.send_score = send_score
+        self.followup_delta = followup_delta
+        self.max_events = max(1, max_events)
+        self.ttl = ttl
+        self.sent = 0
+        self.followups = 0
+        self.evictions = 0
+        self._lock = threading.Condition()
+        # event_id -> TrackedEvent, least recently heard of first
+        self._events = OrderedDict()
+        # (deadline, event_id) of the events waiting out the debounce
+        self._deadlines = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='event-tracker', daemon=True)
+            self._thread.start()
+        return self
+
+    def observe(self, message_type, event, job):
+        """Record one message for the event `job[0]`; `event` is the message's `after` section."""
+        event_id = job[0]
+        now = time.time()
+        with self._lock:
+            tracked = self._events.get(event_id)
+            if tracked is None:
+                tracked = TrackedEvent(now + self.debounce)
+                self._events[event_id] = tracked
+                if self.mode == 'best':
+                    heapq.heappush(self._deadlines, (tracked.deadline, event_id))
+                self._lock.notify()
+            else:
+                self._events.move_to_end(event_id)
+            tracked.last_seen = now
+            tracked.job = job
+            tracked.best_score = max(tracked.best_score, event.get('top_score') or event.get('score') or 0)
+            tracked.has_snapshot = tracked.has_snapshot or bool(event.get('has_snapshot'))
+            ended = message_type == 'end'
+            sends = self._decide(tracked, now, ended)
+            if ended:
+                del self._events[event_id]
+            while len(self._events) > self.max_events:
+                # Out of room: alert on the oldest now rather than lose it
+                _, evicted = self._events.popitem(last=False)
+                self.evictions += 1
+                sends += self._decide(evicted, now, True)
+        self._send(sends)
+
+    def _decide(self, tracked, now, ended=False):
+        if not tracked.has_snapshot:
+            return []
+        if tracked.sent_score is None:
+            if (self.mode == 'early' or ended or now >= tracked.deadline
+                    or (self.send_score and tracked.best_score >= self.send_score)):
+                tracked.sent_score = tracked.best_score
+                self.sent += 1
+                return [(tracked.job, False)]
+        elif (self.mode == 'early' and tracked.claimed and not tracked.followed_up
+              and tracked.best_score >= tracked.sent_score + self.followup_delta):
+            tracked.followed_up = True
+            self.followups += 1
+            return [(tracked.job, True)]
+        return []
+
+    def claimed(self, event_id, won):
+        """Record whether the first alert went out from here; only then may a follow-up."""
+        with self._lock:
+            tracked = self._events.get(event_id)
+            if tracked is None:
+                return
+            tracked.claimed = won
+            # The better snapshot may have come in while the claim was being made
+            sends = self._decide(tracked, time.time()) if won else []
+        self._send(sends)
+
+    def _send(self, sends):
+        for job, followup in sends:
+            try:
+                self.send(job, followup)
+            except Exception as e:
+                logging.error(f"Failed to alert on event ID {job[0]}. Error: {e}")
+
+    def _run(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                sends = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, event_id = heapq.heappop(self._deadlines)
+                    tracked = self._events.get(event_id)
+                    if tracked is not None:
+                        sends += self._decide(tracked, now)
+                while self._events:
+                    event_id, tracked = next(iter(self._events.items()))
+                    if tracked.last_seen >= now - self.ttl:
+                        break
+                    # Frigate never sent its end; an event still without a snapshot is dropped
+                    del self._events[event_id]
+                    self.evictions += 1
+                if not sends:
+                    wakeups = [self._deadlines[0][0]] if self._deadlines else []
+                    if self._events:
+                        wakeups.append(next(iter(self._events.values())).last_seen + self.ttl)
+                    self._lock.wait(max(0, min(wakeups) - now) if wakeups else None)
+                    continue
+            self._send(sends)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self._events), 'sent': self.sent, 'followups': self.followups,
+                    'evictions': self.evictions}
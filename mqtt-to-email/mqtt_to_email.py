@@ -1,263 +1,943 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import json
-import requests
-import smtplib
+import weakref
+from collections import OrderedDict
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
+from urllib.parse import quote
 import logging
 import os
+import queue
+import threading
 import time
 
+from common.clip_token import request_subject
+from common.media import MediaCache, MediaFetcher
+from common.metrics import Counter, Gauge, Histogram, start_http_server, timed
+from common.schedule import DAYS, FULL_DAY, CompiledSchedule
+from common.smtp_pool import SMTP_SECURITY_MODES, SMTPPool
+from common.spool import MailSpool
+from dedup import DedupCache
+from digest import DigestBatcher
+from event_filter import loads
+from lifecycle import ALERT_MODES, EventTracker
+from rules import Rule, RuleSet
+from snapshot import SnapshotProcessor
+
 # Set up logging
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+# Checked on the per-message path so payloads are only formatted when they will be logged
+DEBUG_LOGGING = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-# MQTT settings
-MQTT_BROKER = os.getenv('MQTT_BROKER')
-MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
-MQTT_TOPIC = os.getenv('MQTT_TOPIC') #Frigate NVR events
 NOTIFICATION_TOPIC = "scheduler/notifications" #scheduler_web_server notifications
+STATE_TOPIC = "scheduler/state" #scheduler_web_server full state, retained
+STATE_VERSION = 1
+QUEUE_OVERFLOW_MODES = ('drop_oldest', 'drop_newest', 'block')
+SNAPSHOT_PROCESSING_MODES = ('frigate', 'local')
+MQTT_PROTOCOLS = {'3.1.1': mqtt.MQTTv311, '5': mqtt.MQTTv5}
+# Published by the scheduler itself rather than by someone using it, so they get no notification email
+SILENT_EVENT_TYPES = ('schedule_transition',)
+
+# Every notifier in the process, for the queue depth gauge
+notifiers = weakref.WeakSet()
+
+# Metrics, served on METRICS_PORT; shared by every notifier in the process
+MESSAGES_RECEIVED = Counter('frigate_messages_received_total', 'Messages received on the Frigate events topic')
+EVENTS_FILTERED = Counter('frigate_events_filtered_total', 'Messages dropped before queueing, by reason', ['reason'])
+EVENTS_DEDUPED = Counter('frigate_events_deduplicated_total', 'Messages for events already alerted on')
+EVENTS_DROPPED = Counter('frigate_events_dropped_total', 'Events dropped because the event queue was full')
+EMAILS_QUEUED = Counter('emails_queued_total', 'Emails written to the outgoing spool, by kind', ['kind'])
+EVENT_FAILURES = Counter('event_failures_total', 'Events that could not be turned into an email, by stage', ['stage'])
+ON_MESSAGE_SECONDS = Histogram('on_message_seconds', 'Time spent in the MQTT message callback')
+SNAPSHOT_SECONDS = Histogram('snapshot_download_seconds', 'Time to download and prepare an event snapshot')
+SEND_EMAIL_SECONDS = Histogram('send_email_seconds', 'Time to build an alert email and write it to the spool')
+Gauge('event_queue_depth', 'Events waiting for a worker', lambda: sum(n.event_queue.qsize() for n in list(notifiers)))
+Gauge('events_tracked', 'Events followed by the lifecycle tracker',
+      lambda: sum(n.tracker.stats()['tracked'] for n in list(notifiers) if n.tracker))
+
+
+def env_list(environ, name, default=''):
+    return [value.strip() for value in environ.get(name, default).split(',') if value.strip()]
+
+
+class NotifierConfig:
+    """Settings for one Notifier. `from_env` reads them from the environment variables in the README."""
+
+    def __init__(self, email_address, email_password=None, email_recipient=None, frigate_url=None,
+                 mqtt_broker=None, mqtt_port=1883, mqtt_topic=None, event_types=('person',), cameras=('ALL',),
+                 frigate_event_types=(), zones=(), min_score=0.0, rules_file=None, worker_count=4, queue_size=100,
+                 queue_overflow='drop_oldest', digest_window=0, digest_max_events=10, dedup_max_size=1000,
+                 dedup_ttl=3600, dedup_db=None, schedule_timezone=None, media_prefetch_clips=False,
+                 media_prefetch_delay=15, clip_token_secret=None, mqtt_protocol='3.1.1', mqtt_client_id='',
+                 mqtt_shared_group=None, mqtt_persistent_session=False, mqtt_session_expiry=3600, mqtt_qos=0,
+                 dedup_shared=False, alert_mode='first', alert_debounce=5, alert_send_score=0,
+                 alert_followup_delta=0.1, tracker_max_events=1000, tracker_ttl=600, spool_dir='data/spool',
+                 spool_workers=2, spool_max_attempts=10, spool_backoff_base=30, spool_backoff_max=3600,
+                 smtp_rate_per_minute=0, media_cache_dir='data/media', media_cache_max_bytes=1024 * 1024 * 1024,
+                 media_pool_size=4, frigate_connect_timeout=5, frigate_read_timeout=60, snapshot_processing='frigate',
+                 snapshot_max_dimension=0, snapshot_jpeg_quality=0, snapshot_crop=False, snapshot_crop_padding=0.25,
+                 smtp_host='smtp.gmail.com', smtp_port=587, smtp_security='starttls', smtp_pool_size=2, smtp_timeout=30,
+                 smtp_probe_after=10, smtp_max_idle=240):
+        if queue_overflow not in QUEUE_OVERFLOW_MODES:
+            logging.warning(f"Unknown QUEUE_OVERFLOW '{queue_overflow}', falling back to drop_oldest")
+            queue_overflow = 'drop_oldest'
+        if mqtt_protocol not in MQTT_PROTOCOLS:
+            logging.warning(f"Unknown MQTT_PROTOCOL '{mqtt_protocol}', falling back to 3.1.1")
+            mqtt_protocol = '3.1.1'
+        if mqtt_persistent_session and not mqtt_client_id:
+            # The broker finds the session by client ID, so a random one would start afresh every time
+            logging.warning("MQTT_PERSISTENT_SESSION needs MQTT_CLIENT_ID, falling back to a clean session")
+            mqtt_persistent_session = False
+        if alert_mode not in ALERT_MODES:
+            logging.warning(f"Unknown ALERT_MODE '{alert_mode}', falling back to first")
+            alert_mode = 'first'
+        if dedup_shared and not dedup_db:
+            logging.warning("DEDUP_SHARED needs DEDUP_DB, deduplicating within this process only")
+            dedup_shared = False
+        if snapshot_processing not in SNAPSHOT_PROCESSING_MODES:
+            logging.warning(f"Unknown SNAPSHOT_PROCESSING '{snapshot_processing}', falling back to frigate")
+            snapshot_processing = 'frigate'
+        if smtp_security not in SMTP_SECURITY_MODES:
+            logging.warning(f"Unknown SMTP_SECURITY '{smtp_security}', falling back to starttls")
+            smtp_security = 'starttls'
+        self.email_address = email_address
+        self.email_password = email_password
+        self.email_recipient = email_recipient
+        self.frigate_url = frigate_url
+        self.mqtt_broker = mqtt_broker
+        self.mqtt_port = mqtt_port
+        self.mqtt_topic = mqtt_topic
+        self.event_types = list(event_types)
+        self.cameras = list(cameras)
+        self.frigate_event_types = list(frigate_event_types)
+        self.zones = list(zones)
+        self.min_score = min_score
+        self.rules_file = rules_file
+        self.worker_count = max(1, worker_count)
+        self.queue_size = queue_size
+        self.queue_overflow = queue_overflow
+        self.digest_window = digest_window
+        self.digest_max_events = digest_max_events
+        self.dedup_max_size = dedup_max_size
+        self.dedup_ttl = dedup_ttl
+        self.dedup_db = dedup_db
+        self.schedule_timezone = schedule_timezone
+        self.media_prefetch_clips = media_prefetch_clips
+        self.media_prefetch_delay = media_prefetch_delay
+        self.clip_token_secret = clip_token_secret
+        self.mqtt_protocol = mqtt_protocol
+        self.mqtt_client_id = mqtt_client_id
+        self.mqtt_shared_group = mqtt_shared_group
+        self.mqtt_persistent_session = mqtt_persistent_session
+        self.mqtt_session_expiry = mqtt_session_expiry
+        self.mqtt_qos = mqtt_qos
+        self.dedup_shared = dedup_shared
+        self.alert_mode = alert_mode
+        self.alert_debounce = alert_debounce
+        self.alert_send_score = alert_send_score
+        self.alert_followup_delta = alert_followup_delta
+        self.tracker_max_events = tracker_max_events
+        self.tracker_ttl = tracker_ttl
+        self.spool_dir = spool_dir
+        self.spool_workers = spool_workers
+        self.spool_max_attempts = spool_max_attempts
+        self.spool_backoff_base = spool_backoff_base
+        self.spool_backoff_max = spool_backoff_max
+        self.smtp_rate_per_minute = smtp_rate_per_minute
+        self.media_cache_dir = media_cache_dir
+        self.media_cache_max_bytes = media_cache_max_bytes
+        self.media_pool_size = media_pool_size
+        self.frigate_connect_timeout = frigate_connect_timeout
+        self.frigate_read_timeout = frigate_read_timeout
+        self.snapshot_processing = snapshot_processing
+        self.snapshot_max_dimension = snapshot_max_dimension
+        self.snapshot_jpeg_quality = snapshot_jpeg_quality
+        self.snapshot_crop = snapshot_crop
+        self.snapshot_crop_padding = snapshot_crop_padding
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_security = smtp_security
+        self.smtp_pool_size = smtp_pool_size
+        self.smtp_timeout = smtp_timeout
+        self.smtp_probe_after = smtp_probe_after
+        self.smtp_max_idle = smtp_max_idle
+
+    @classmethod
+    def from_env(cls, environ=None):
+        env = os.environ if environ is None else environ
+        persistent_session = env.get('MQTT_PERSISTENT_SESSION', 'false').lower() == 'true'
+        return cls(
+            email_address=env.get('EMAIL_ADDRESS'),
+            email_password=env.get('EMAIL_PASSWORD'),
+            email_recipient=env.get('EMAIL_RECIPIENT'),
+            frigate_url=f"http://{env.get('FRIGATE_HOST')}:{env.get('FRIGATE_PORT')}",
+            mqtt_broker=env.get('MQTT_BROKER'),
+            mqtt_port=int(env.get('MQTT_PORT', 1883)),
+            mqtt_topic=env.get('MQTT_TOPIC'),  # Frigate NVR events
+            # Event type filter (comma-separated list of labels)
+            event_types=env_list(env, 'EVENT_TYPE', 'person'),
+            # Camera filter (comma-separated list of cameras or "ALL")
+            cameras=env_list(env, 'CAMERAS', 'ALL'),
+            # Frigate message types (new, update, end), zones and minimum score; empty means any
+            frigate_event_types=env_list(env, 'FRIGATE_EVENT_TYPES'),
+            zones=env_list(env, 'ZONES'),
+            min_score=float(env.get('MIN_SCORE', 0)),
+            # Rule table (JSON): routes camera/label/zone/score/type matches to recipients.
+            # Without it, a single rule is built from the filters above and sent to EMAIL_RECIPIENT.
+            rules_file=env.get('RULES_FILE'),
+            # Worker pool settings: snapshot download and SMTP send run off the MQTT network thread
+            worker_count=int(env.get('WORKER_COUNT', 4)),
+            queue_size=int(env.get('QUEUE_SIZE', 100)),
+            queue_overflow=env.get('QUEUE_OVERFLOW', 'drop_oldest').lower(),
+            # Digest mode: collect events for DIGEST_WINDOW seconds and send them in one email (0 sends each event on its own)
+            digest_window=float(env.get('DIGEST_WINDOW', 0)),
+            digest_max_events=int(env.get('DIGEST_MAX_EVENTS', 10)),
+            # Track processed event IDs (DEDUP_DB keeps them across restarts)
+            dedup_max_size=int(env.get('DEDUP_MAX_SIZE', 1000)),
+            dedup_ttl=float(env.get('DEDUP_TTL', 3600)),  # seconds since an event was last seen
+            dedup_db=env.get('DEDUP_DB'),
+            # Time zone the schedule is written in (e.g. Europe/Amsterdam); defaults to the container's local time
+            schedule_timezone=env.get('SCHEDULE_TIMEZONE'),
+            # Download the clip of every alerted event when it ends, so a "Send Clip" reply is served from disk
+            media_prefetch_clips=env.get('MEDIA_PREFETCH_CLIPS', 'false').lower() == 'true',
+            media_prefetch_delay=float(env.get('MEDIA_PREFETCH_DELAY', 15)),  # seconds for Frigate to finish writing the clip
+            # Shared with email-listener, which verifies the signed clip requests
+            clip_token_secret=env.get('CLIP_TOKEN_SECRET'),
+            # Scale-out: replicas in the same MQTT_SHARED_GROUP split the Frigate events between them
+            # ($share/<group>/<topic>), and DEDUP_SHARED makes them claim event IDs in the one DEDUP_DB
+            mqtt_protocol=env.get('MQTT_PROTOCOL', '3.1.1'),
+            mqtt_client_id=env.get('MQTT_CLIENT_ID', ''),
+            mqtt_shared_group=env.get('MQTT_SHARED_GROUP') or None,
+            # Keep the session, and the events queued for it, while the service is down or reconnecting
+            mqtt_persistent_session=persistent_session,
+            mqtt_session_expiry=int(env.get('MQTT_SESSION_EXPIRY', 3600)),  # seconds, MQTT 5 only
+            mqtt_qos=int(env.get('MQTT_QOS', 1 if persistent_session else 0)),
+            dedup_shared=env.get('DEDUP_SHARED', 'false').lower() == 'true',
+            # When to alert on an event: on its first message (first), once Frigate has had time to find the
+            # best snapshot (best), or straight away with one follow-up if the score rises (early)
+            alert_mode=env.get('ALERT_MODE', 'first').lower(),
+            alert_debounce=float(env.get('ALERT_DEBOUNCE', 5)),  # seconds after the first message, best mode
+            alert_send_score=float(env.get('ALERT_SEND_SCORE', 0)),  # send sooner once the score reaches it; 0 waits
+            alert_followup_delta=float(env.get('ALERT_FOLLOWUP_SCORE_DELTA', 0.1)),  # early mode
+            tracker_max_events=int(env.get('TRACKER_MAX_EVENTS', 1000)),
+            tracker_ttl=float(env.get('TRACKER_TTL', 600)),  # seconds without a message before an event is forgotten
+            # Outgoing mail is written to an on-disk spool first and retried from there; one directory per service
+            spool_dir=env.get('SPOOL_DIR', 'data/spool'),
+            spool_workers=int(env.get('SPOOL_WORKERS', env.get('SMTP_POOL_SIZE', 2))),
+            spool_max_attempts=int(env.get('SPOOL_MAX_ATTEMPTS', 10)),
+            spool_backoff_base=float(env.get('SPOOL_BACKOFF_BASE', 30)),  # seconds before the first retry, doubled per attempt
+            spool_backoff_max=float(env.get('SPOOL_BACKOFF_MAX', 3600)),
+            smtp_rate_per_minute=float(env.get('SMTP_RATE_PER_MINUTE', 0)),  # 0 means unthrottled
+            # On-disk media cache, shared with email-listener, which serves clips from it; 0 bytes disables it
+            media_cache_dir=env.get('MEDIA_CACHE_DIR', 'data/media'),
+            media_cache_max_bytes=int(env.get('MEDIA_CACHE_MAX_BYTES', 1024 * 1024 * 1024)),
+            media_pool_size=int(env.get('MEDIA_POOL_SIZE', 4)),  # keep-alive connections to Frigate
+            frigate_connect_timeout=float(env.get('FRIGATE_CONNECT_TIMEOUT', 5)),
+            frigate_read_timeout=float(env.get('FRIGATE_READ_TIMEOUT', 60)),
+            # Snapshot processing: by Frigate (frigate) or with Pillow (local)
+            snapshot_processing=env.get('SNAPSHOT_PROCESSING', 'frigate').lower(),
+            snapshot_max_dimension=int(env.get('SNAPSHOT_MAX_DIMENSION', 0)),  # 0 keeps the original size
+            snapshot_jpeg_quality=int(env.get('SNAPSHOT_JPEG_QUALITY', 0)),  # 0 keeps Frigate's encoding
+            snapshot_crop=env.get('SNAPSHOT_CROP', 'false').lower() == 'true',  # crop to the detected object
+            snapshot_crop_padding=float(env.get('SNAPSHOT_CROP_PADDING', 0.25)),  # margin around the box, as a fraction of its size
+            # Outgoing mail server and the authenticated sessions kept open to it
+            smtp_host=env.get('SMTP_HOST', 'smtp.gmail.com'),
+            smtp_port=int(env.get('SMTP_PORT', 587)),
+            smtp_security=env.get('SMTP_SECURITY', 'starttls').lower(),  # starttls, ssl or none
+            smtp_pool_size=int(env.get('SMTP_POOL_SIZE', 2)),
+            smtp_timeout=float(env.get('SMTP_TIMEOUT', 30)),
+            smtp_probe_after=float(env.get('SMTP_PROBE_AFTER', 10)),  # seconds idle before a NOOP probe
+            smtp_max_idle=float(env.get('SMTP_MAX_IDLE', 240)),  # seconds idle before a session is dropped unprobed
+        )
+
+    def log(self):
+        # Log the settings, except the password
+        logging.debug(f"MQTT_BROKER={self.mqtt_broker}")
+        logging.debug(f"MQTT_PORT={self.mqtt_port}")
+        logging.debug(f"MQTT_TOPIC={self.mqtt_topic}")
+        logging.debug(f"MQTT_PROTOCOL={self.mqtt_protocol}")
+        logging.debug(f"MQTT_CLIENT_ID={self.mqtt_client_id}")
+        logging.debug(f"MQTT_SHARED_GROUP={self.mqtt_shared_group}")
+        logging.debug(f"MQTT_PERSISTENT_SESSION={self.mqtt_persistent_session}")
+        logging.debug(f"MQTT_QOS={self.mqtt_qos}")
+        logging.debug(f"EMAIL_ADDRESS={self.email_address}")
+        logging.debug(f"EMAIL_RECIPIENT={self.email_recipient}")
+        logging.debug(f"FRIGATE_URL={self.frigate_url}")
+        logging.debug(f"EVENT_TYPE={self.event_types}")
+        logging.debug(f"CAMERAS={self.cameras}")
+        logging.debug(f"FRIGATE_EVENT_TYPES={self.frigate_event_types}")
+        logging.debug(f"ZONES={self.zones}")
+        logging.debug(f"MIN_SCORE={self.min_score}")
+        logging.debug(f"RULES_FILE={self.rules_file}")
+        logging.debug(f"SCHEDULE_TIMEZONE={self.schedule_timezone}")
+        logging.debug(f"WORKER_COUNT={self.worker_count}")
+        logging.debug(f"QUEUE_SIZE={self.queue_size}")
+        logging.debug(f"QUEUE_OVERFLOW={self.queue_overflow}")
+        logging.debug(f"DEDUP_MAX_SIZE={self.dedup_max_size}")
+        logging.debug(f"DEDUP_TTL={self.dedup_ttl}")
+        logging.debug(f"DEDUP_DB={self.dedup_db}")
+        logging.debug(f"DEDUP_SHARED={self.dedup_shared}")
+        logging.debug(f"ALERT_MODE={self.alert_mode}")
+        logging.debug(f"ALERT_DEBOUNCE={self.alert_debounce}")
+        logging.debug(f"ALERT_SEND_SCORE={self.alert_send_score}")
+        logging.debug(f"ALERT_FOLLOWUP_SCORE_DELTA={self.alert_followup_delta}")
+        logging.debug(f"DIGEST_WINDOW={self.digest_window}")
+        logging.debug(f"DIGEST_MAX_EVENTS={self.digest_max_events}")
+        logging.debug(f"MEDIA_PREFETCH_CLIPS={self.media_prefetch_clips}")
+        logging.debug(f"SMTP_HOST={self.smtp_host}")
+        logging.debug(f"SMTP_PORT={self.smtp_port}")
+        logging.debug(f"SMTP_SECURITY={self.smtp_security}")
+        logging.debug(f"SMTP_POOL_SIZE={self.smtp_pool_size}")
+        logging.debug(f"SPOOL_DIR={self.spool_dir}")
+        logging.debug(f"SPOOL_WORKERS={self.spool_workers}")
+        logging.debug(f"SMTP_RATE_PER_MINUTE={self.smtp_rate_per_minute}")
+        logging.debug(f"MEDIA_CACHE_DIR={self.media_cache_dir}")
+        logging.debug(f"MEDIA_CACHE_MAX_BYTES={self.media_cache_max_bytes}")
+        logging.debug(f"SNAPSHOT_PROCESSING={self.snapshot_processing}")
+        logging.debug(f"SNAPSHOT_MAX_DIMENSION={self.snapshot_max_dimension}")
+        logging.debug(f"SNAPSHOT_JPEG_QUALITY={self.snapshot_jpeg_quality}")
+        logging.debug(f"SNAPSHOT_CROP={self.snapshot_crop}")
+        logging.debug(f"CLIP_TOKEN_SECRET={'set' if self.clip_token_secret else 'not set'}")
+
+
+class NotifierState:
+    """Snooze, on/off switch and weekly schedule, changed from the MQTT thread and read by the event workers."""
+
+    def __init__(self, timezone=None):
+        self.timezone = timezone
+        self._lock = threading.Lock()
+        self.snooze_end_time = None
+        self.email_sending_enabled = True
+        # Default schedule: always send emails (24 hours a day, 7 days a week)
+        self.schedule = {day: dict(FULL_DAY) for day in DAYS}
+        self.compiled_schedule = CompiledSchedule(self.schedule, timezone)
+        # (allowed, until) from the scheduler's last schedule_transition; trusted until then
+        self.schedule_edge = None
+        # Position in the scheduler's sequence of changes, to drop stale and duplicate ones
+        self.epoch = None
+        self.seq = None
+
+    def accept(self, epoch, seq, allow_equal=False):
+        """Whether a change numbered `seq` is newer than the state; moves the state up to it if so."""
+        if seq is None:
+            # Not sequenced, e.g. published by hand
+            return True
+        with self._lock:
+            if epoch == self.epoch and self.seq is not None and (seq < self.seq or (seq == self.seq and not allow_equal)):
+                return False
+            self.epoch = epoch
+            self.seq = seq
+            return True
+
+    def load(self, document):
+        """Replace everything with a scheduler/state document. Returns False if it is older than the state."""
+        if document.get('version', STATE_VERSION) > STATE_VERSION:
+            logging.warning(f"Scheduler state version {document.get('version')} is newer than this service knows, "
+                            f"reading the fields it understands")
+        # The document repeats the delta with the same number, so that one is not stale
+        if not self.accept(document.get('epoch'), document.get('seq'), allow_equal=True):
+            return False
+        schedule = {day: dict(FULL_DAY) for day in DAYS}
+        schedule.update(document.get('schedule') or {})
+        compiled_schedule = CompiledSchedule(schedule, document.get('timezone') or self.timezone)
+        edge = document.get('schedule_edge')
+        with self._lock:
+            self.email_sending_enabled = document.get('email_sending_enabled', True)
+            self.snooze_end_time = document.get('snooze_until')
+            self.schedule = schedule
+            self.compiled_schedule = compiled_schedule
+            self.schedule_edge = (bool(edge['allowed']), float(edge['until'])) if edge else None
+        return True
+
+    def snooze(self, minutes, until=None):
+        if until is None and minutes:
+            until = time.time() + minutes * 60
+        with self._lock:
+            self.snooze_end_time = until
+
+    def set_enabled(self, enabled):
+        with self._lock:
+            self.email_sending_enabled = enabled
+
+    def set_schedule(self, schedule, timezone=None):
+        with self._lock:
+            self.schedule = dict(self.schedule, **schedule)
+            self.compiled_schedule = CompiledSchedule(self.schedule, timezone or self.timezone)
+            # Belonged to the old schedule; the scheduler follows up with the edge for the new one
+            self.schedule_edge = None
+            return self.compiled_schedule
+
+    def apply_transition(self, allowed, until):
+        with self._lock:
+            self.schedule_edge = (bool(allowed), float(until or 0))
+
+    def blocked_reason(self, now=None):
+        """Why email sending is blocked right now, or None when it is allowed."""
+        now = time.time() if now is None else now
+        with self._lock:
+            snooze_end_time = self.snooze_end_time
+            enabled = self.email_sending_enabled
+            compiled_schedule = self.compiled_schedule
+            schedule_edge = self.schedule_edge
+        if snooze_end_time and now < snooze_end_time:
+            return f"Email sending is currently snoozed. Remaining time: {snooze_end_time - now:.2f} seconds"
+        if not enabled:
+            return "Email sending is currently DISABLED."
+        # Check if current time is within the scheduled time range; the pushed edge saves evaluating the schedule,
+        # and once it runs out (the scheduler is down or late) the local copy of the schedule takes over
+        if schedule_edge and now < schedule_edge[1]:
+            allowed = schedule_edge[0]
+        else:
+            allowed = compiled_schedule.allowed(now)
+        if not allowed:
+            return "Email sending is out of schedule range."
+        return None
+
 
-# Email settings
-EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
-EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
-EMAIL_RECIPIENT = os.getenv('EMAIL_RECIPIENT')
-
-# Frigate settings
-FRIGATE_HOST = os.getenv('FRIGATE_HOST')
-FRIGATE_PORT = os.getenv('FRIGATE_PORT')
-
-# Event type filter
-EVENT_TYPE = os.getenv('EVENT_TYPE', 'person')
-
-# Camera filter (comma-separated list of cameras or "ALL")
-CAMERAS = os.getenv('CAMERAS', 'ALL').split(',')
-
-# Track the last processed event IDs
-last_event_ids = []
-
-# Track snooze end time
-snooze_end_time = None
-
-# Email sending schedule and status
-email_sending_enabled = True
-
-# Default schedule: always send emails (24 hours a day, 7 days a week)
-current_schedule = {
-    "monday": {"start_time": "00:00", "end_time": "23:59"},
-    "tuesday": {"start_time": "00:00", "end_time": "23:59"},
-    "wednesday": {"start_time": "00:00", "end_time": "23:59"},
-    "thursday": {"start_time": "00:00", "end_time": "23:59"},
-    "friday": {"start_time": "00:00", "end_time": "23:59"},
-    "saturday": {"start_time": "00:00", "end_time": "23:59"},
-    "sunday": {"start_time": "00:00", "end_time": "23:59"},
-}
-
-# Log environment variables
-logging.debug(f"MQTT_BROKER={MQTT_BROKER}")
-logging.debug(f"MQTT_PORT={MQTT_PORT}")
-logging.debug(f"MQTT_TOPIC={MQTT_TOPIC}")
-logging.debug(f"EMAIL_ADDRESS={EMAIL_ADDRESS}")
-logging.debug(f"EMAIL_RECIPIENT={EMAIL_RECIPIENT}")
-logging.debug(f"FRIGATE_HOST={FRIGATE_HOST}")
-logging.debug(f"FRIGATE_PORT={FRIGATE_PORT}")
-logging.debug(f"EVENT_TYPE={EVENT_TYPE}")
-logging.debug(f"CAMERAS={CAMERAS}")
-
-def is_email_sending_allowed():
-    global snooze_end_time, email_sending_enabled, current_schedule
-    if snooze_end_time and time.time() < snooze_end_time:
-        remaining_time = snooze_end_time - time.time()
-        logging.info(f"Email sending is currently snoozed. Remaining time: {remaining_time:.2f} seconds")
-        return False
-    if not email_sending_enabled:
-        logging.info("Email sending is currently DISABLED.")
-        return False
-    
-    # Check if current time is within the scheduled time range
-    current_time = time.strftime("%H:%M")
-    current_day = time.strftime("%A").lower()
-    day_schedule = current_schedule.get(current_day, {"start_time": "00:00", "end_time": "23:59"})
-
-    # Check if current time is within the active time frame
-    if not (day_schedule["start_time"] <= current_time <= day_schedule["end_time"]):
-        schedule_str = ', '.join([f"{day.capitalize()} {times['start_time']} - {times['end_time']}" for day, times in current_schedule.items()])
-        logging.info(f"Email sending is out of schedule range. Schedule: {schedule_str}")
-        return False
-
-    return True
-
-def send_notification_email(event_type, details):
-    subject = f"Scheduler Notification: {event_type}"
-    body = f"Details: {details}"
-    html = f"""
-    <html>
-        <body>
-            <p>{body}</p>
-        </body>
-    </html>
+class Notifier:
+    """One Frigate events to email pipeline: rule filter, dedup, snapshot workers and the outgoing spool.
+
+    Building one does no I/O. The rules, spool, dedup store, Frigate session and
+    worker threads are set up by `start()`, which `connect()` and the first message call. Pass
+    `smtp_pool`, `spool` or `media` to share them between notifiers in one process,
+    e.g. one per Frigate instance or recipient group; the rest are built from `config`.
+    Notifiers that are not given a spool need a SPOOL_DIR each.
     """
 
-    msg = MIMEMultipart("alternative")
-    msg['From'] = EMAIL_ADDRESS
-    msg['To'] = EMAIL_RECIPIENT
-    msg['Subject'] = subject
+    def __init__(self, config, smtp_pool=None, spool=None, media=None):
+        self.config = config
+        self.state = NotifierState(config.schedule_timezone)
+        self.smtp_pool = smtp_pool
+        self.spool = spool
+        self.media = media
+        self.snapshots = SnapshotProcessor(config.snapshot_processing, config.snapshot_max_dimension,
+                                           config.snapshot_jpeg_quality, config.snapshot_crop,
+                                           config.snapshot_crop_padding)
+        self.rules = None
+        # Events waiting for a worker
+        self.event_queue = queue.Queue(maxsize=config.queue_size)
+        self.dedup = None
+        self.digest = None
+        self.tracker = None
+        self.client = None
+        # Events an email went out for, so their clips can be prefetched when they end
+        self._alerted_events = OrderedDict()
+        self._alerted_events_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started = False
+        notifiers.add(self)
+
+    def load_rules(self):
+        config = self.config
+        if config.rules_file:
+            return RuleSet.load(config.rules_file, [config.email_recipient])
+        return RuleSet([Rule('default', [config.email_recipient], config.cameras, config.event_types,
+                             config.frigate_event_types, config.zones, config.min_score)])
+
+    def start(self):
+        """Open the spool and dedup store and start the event workers; later calls do nothing."""
+        if self._started:
+            return self
+        with self._start_lock:
+            if self._started:
+                return self
+            config = self.config
+            # First, so a broken RULES_FILE fails before anything else is set up
+            self.rules = self.load_rules()
+            if self.smtp_pool is None:
+                # Authenticated SMTP sessions shared by the event workers and notification emails
+                self.smtp_pool = SMTPPool(config.smtp_host, config.smtp_port, config.email_address,
+                                          config.email_password, size=config.smtp_pool_size,
+                                          security=config.smtp_security, timeout=config.smtp_timeout,
+                                          probe_after=config.smtp_probe_after, max_idle=config.smtp_max_idle)
+            if self.spool is None:
+                # Outgoing mail is written to an on-disk spool first and retried from there
+                # (refuses a directory another spool in this process already uses)
+                self.spool = MailSpool(config.spool_dir, self.smtp_pool, workers=config.spool_workers,
+                                       max_attempts=config.spool_max_attempts, backoff_base=config.spool_backoff_base,
+                                       backoff_max=config.spool_backoff_max, rate_per_minute=config.smtp_rate_per_minute)
+            if self.media is None:
+                # Pooled Frigate session and the on-disk media cache (shared with email-listener, which serves clips from it)
+                cache = (MediaCache(config.media_cache_dir, config.media_cache_max_bytes)
+                         if config.media_cache_max_bytes > 0 else None)
+                self.media = MediaFetcher(config.frigate_url, cache,
+                                          timeout=(config.frigate_connect_timeout, config.frigate_read_timeout),
+                                          pool_size=config.media_pool_size)
+            self.dedup = DedupCache(config.dedup_max_size, config.dedup_ttl, config.dedup_db, config.dedup_shared)
+            if config.digest_window > 0:
+                self.digest = DigestBatcher(config.digest_window, config.digest_max_events, self.send_digest_email)
+            if config.alert_mode != 'first':
+                self.tracker = EventTracker(config.alert_mode, self.alert_event, config.alert_debounce,
+                                            config.alert_send_score, config.alert_followup_delta,
+                                            config.tracker_max_events, config.tracker_ttl).start()
+            for rule_description in self.rules.describe():
+                logging.debug(f"Rule {rule_description}")
+            logging.debug(f"SMTP={self.smtp_pool.host}:{self.smtp_pool.port} "
+                          f"({self.smtp_pool.security}, pool size {self.smtp_pool.size})")
+            logging.debug(f"MEDIA_CACHE={self.media.cache.directory if self.media.cache else None}")
+
+            self.spool.start()
+            for i in range(config.worker_count):
+                worker = threading.Thread(target=self.event_worker, name=f"event-worker-{i}", daemon=True)
+                worker.start()
+            logging.debug(f"Started {config.worker_count} event worker(s)")
+            self._started = True
+        return self
+
+    def is_email_sending_allowed(self):
+        reason = self.state.blocked_reason()
+        if reason:
+            logging.info(reason)
+            return False
+        return True
+
+    def send_notification_email(self, event_type, details):
+        subject = f"Scheduler Notification: {event_type}"
+        body = f"Details: {details}"
+        html = f"""
+        <html>
+            <body>
+                <p>{body}</p>
+            </body>
+        </html>
+        """
+
+        msg = MIMEMultipart("alternative")
+        msg['From'] = self.config.email_address
+        msg['To'] = self.config.email_recipient
+        msg['Subject'] = subject
+
+        msg.attach(MIMEText(body, 'plain'))
+        msg.attach(MIMEText(html, 'html'))
+
+        try:
+            logging.debug("Queueing notification email...")
+            self.spool.enqueue(self.config.email_address, [self.config.email_recipient], msg)
+            EMAILS_QUEUED.inc(kind='notification')
+            logging.debug("Notification email queued for sending")
+        except Exception as e:
+            logging.error(f"Failed to queue notification email. Error: {e}")
+
+    def connect(self):
+        """Create the MQTT client and connect it to the broker; the caller runs its network loop."""
+        self.start()
+        config = self.config
+        logging.debug(f"Connecting to MQTT broker at {config.mqtt_broker}:{config.mqtt_port}")
+        protocol = MQTT_PROTOCOLS[config.mqtt_protocol]
+        connect_args = {}
+        if protocol == mqtt.MQTTv5:
+            self.client = mqtt.Client(client_id=config.mqtt_client_id, protocol=protocol)
+            connect_args['clean_start'] = not config.mqtt_persistent_session
+            if config.mqtt_persistent_session:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = config.mqtt_session_expiry
+                connect_args['properties'] = properties
+        else:
+            self.client = mqtt.Client(client_id=config.mqtt_client_id, clean_session=not config.mqtt_persistent_session,
+                                      protocol=protocol)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        # The network loop reconnects by itself, waiting longer after each failed attempt
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self.client.connect(config.mqtt_broker, config.mqtt_port, 60, **connect_args)
+        return self.client
+
+    def event_subscription(self):
+        """The Frigate events topic, through the shared subscription when replicas split the load."""
+        if self.config.mqtt_shared_group:
+            return f"$share/{self.config.mqtt_shared_group}/{self.config.mqtt_topic}"
+        return self.config.mqtt_topic
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        logging.debug(f"Connected to MQTT broker with result code {rc}, session present: {flags.get('session present')}")
+        # The retained state document first, so the events that follow are judged by the current state.
+        # Every replica needs the scheduler topics, so only the events are shared.
+        event_topic = self.event_subscription()
+        client.subscribe([(STATE_TOPIC, 1), (event_topic, self.config.mqtt_qos), (NOTIFICATION_TOPIC, 0)])
+        logging.debug(f"Subscribed to topics: {STATE_TOPIC}, {event_topic}, {NOTIFICATION_TOPIC}")
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        # loop_forever() reconnects with the delays set in connect()
+        logging.warning(f"Disconnected from MQTT broker with result code {rc}")
+
+    @timed(ON_MESSAGE_SECONDS)
+    def on_message(self, client, userdata, msg):
+        if DEBUG_LOGGING:
+            logging.debug(f"Received MQTT message on topic: {msg.topic}")
+
+        # Handle empty payloads
+        if not msg.payload:
+            logging.debug("Received empty payload, ignoring message.")
+            return
 
-    msg.attach(MIMEText(body, 'plain'))
-    msg.attach(MIMEText(html, 'html'))
+        self.start()
+        if msg.topic == STATE_TOPIC:
+            self.handle_state(msg.payload)
+        elif msg.topic == NOTIFICATION_TOPIC:
+            if msg.retain:
+                # A replay of an old change (from before deltas stopped being retained); the state document covers it
+                logging.debug("Ignoring retained notification")
+                return
+            self.handle_notification(msg.payload)
+        else:
+            self.handle_event(msg.payload)
 
-    try:
-        logging.debug("Attempting to send notification email...")
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, EMAIL_RECIPIENT, text)
-        server.quit()
-        logging.debug("Notification email sent successfully!")
-    except Exception as e:
-        logging.error(f"Failed to send notification email. Error: {e}")
-
-def on_connect(client, userdata, flags, rc):
-    logging.debug(f"Connected to MQTT broker with result code {rc}")
-    client.subscribe(MQTT_TOPIC)
-    # Delayed subscription to avoid retained messages
-    time.sleep(2)  # Adjust the sleep duration as needed
-    client.subscribe(NOTIFICATION_TOPIC)
-    logging.debug(f"Subscribed to topics: {MQTT_TOPIC}, {NOTIFICATION_TOPIC}")
-
-def on_disconnect(client, userdata, rc):
-    logging.warning(f"Disconnected from MQTT broker with result code {rc}")
-    # Attempt to reconnect
-    client.reconnect()
-
-def on_message(client, userdata, msg):
-    global last_event_ids, snooze_end_time, email_sending_enabled, current_schedule
-    logging.debug(f"Received MQTT message on topic: {msg.topic}")
-
-    # Handle empty payloads
-    if not msg.payload:
-        logging.debug("Received empty payload, ignoring message.")
-        return
-
-    if msg.topic == NOTIFICATION_TOPIC:
-        payload = json.loads(msg.payload.decode('utf-8'))
+    def handle_state(self, raw):
+        try:
+            document = json.loads(raw.decode('utf-8'))
+        except ValueError as e:
+            logging.error(f"Ignoring malformed scheduler state. Error: {e}")
+            return
+        if self.state.load(document):
+            logging.info(f"Loaded scheduler state {document.get('seq')}: email sending "
+                         f"{'enabled' if document.get('email_sending_enabled', True) else 'disabled'}, "
+                         f"schedule {self.state.compiled_schedule.describe()}")
+        else:
+            logging.debug(f"Ignoring stale scheduler state {document.get('seq')}")
+
+    def handle_notification(self, raw):
+        payload = json.loads(raw.decode('utf-8'))
         event_type = payload.get('event_type')
         details = payload.get('details')
+        if not self.state.accept(payload.get('epoch'), payload.get('seq')):
+            logging.debug(f"Ignoring stale or duplicate notification {payload.get('seq')}: {event_type}")
+            return
         logging.info(f"Received notification: {event_type} - {details}")
 
         if event_type == "snooze_set":
-            # Set the snooze end time
+            # Set the snooze end time; 'until' is absolute, so a late delivery does not stretch the snooze
             cooldown_minutes = details.get('cooldown_minutes', 120)
-            snooze_end_time = time.time() + cooldown_minutes * 60
+            self.state.snooze(cooldown_minutes, details.get('until'))
             logging.info(f"Snoozed for {cooldown_minutes} minutes")
 
         elif event_type == "email_sending_toggled":
-            email_sending_enabled = details.get('enabled', True)
-            logging.info(f"Email sending enabled: {email_sending_enabled}")
+            enabled = details.get('enabled', True)
+            self.state.set_enabled(enabled)
+            logging.info(f"Email sending enabled: {enabled}")
 
         elif event_type == "schedule_set":
             # Update the current schedule
             new_schedule = details.get('schedule', {})
             if new_schedule:
-                current_schedule.update(new_schedule)
-                logging.info(f"Schedule set: {current_schedule}")
+                compiled_schedule = self.state.set_schedule(new_schedule, details.get('timezone'))
+                logging.info(f"Schedule set: {compiled_schedule.describe()}")
+
+        elif event_type == "schedule_transition":
+            # The scheduler's timer fired: sending is now allowed or not until `until`
+            self.state.apply_transition(details.get('allowed', True), details.get('until'))
+            logging.info(f"Schedule transition: email sending {'allowed' if details.get('allowed', True) else 'not allowed'}")
+
+        elif event_type == "rules_reload":
+            # Re-read RULES_FILE; rules are never taken from the message, since anyone on the broker could send them
+            try:
+                self.rules = self.load_rules()
+                logging.info(f"Reloaded {len(self.rules.rules)} rule(s)")
+            except Exception as e:
+                logging.error(f"Failed to reload rules, keeping the previous ones. Error: {e}")
+
+        if event_type not in SILENT_EVENT_TYPES:
+            if self.dedup.shared and payload.get('epoch') is not None:
+                # Every replica gets the notification, and the one that claims it sends the email.
+                # The claim may wait on another replica's lock, so it is made off the MQTT thread
+                threading.Thread(target=self.notify_once,
+                                 args=(f"notification:{payload['epoch']}-{payload.get('seq')}", event_type, details),
+                                 name='notification', daemon=True).start()
+            else:
+                self.send_notification_email(event_type, details)
+
+    def notify_once(self, key, event_type, details):
+        if self.dedup.claim_once(key):
+            self.send_notification_email(event_type, details)
+        else:
+            logging.debug(f"Notification {key} is emailed by another replica")
+
+    def handle_event(self, raw):
+        MESSAGES_RECEIVED.inc()
+        # Most messages are for other cameras or labels; drop those before decoding
+        ruleset = self.rules
+        if ruleset.quick_reject(raw):
+            EVENTS_FILTERED.inc(reason='quick_reject')
+            return
 
-        send_notification_email(event_type, details)
-    else:
-        payload = json.loads(msg.payload.decode('utf-8'))
+        payload = loads(raw)
+        if DEBUG_LOGGING:
+            logging.debug(f"Received message: {payload}")
+
+        self.route_event(ruleset, payload)
+        # After routing, so an event the tracker alerts on as it ends still gets its clip
+        if self.config.media_prefetch_clips and payload.get('type') == 'end':
+            self.prefetch_clip(payload['after'])
+
+    def route_event(self, ruleset, payload):
+        matched = ruleset.match(payload)
+        if not matched:
+            EVENTS_FILTERED.inc(reason='rules')
+            if DEBUG_LOGGING:
+                logging.debug(f"No rule matches {payload['after']['label']} on camera '{payload['after']['camera']}'. Ignoring event.")
+            return
 
         event_id = payload['after']['id']
         camera_name = payload['after']['camera']
-        event_label = payload['after']['label']
-
-        logging.debug(f"Received message: {payload}")
-
-        # Check if the camera sent the event is in the CAMERAS list
-        if 'ALL' not in CAMERAS and camera_name not in CAMERAS:
-            logging.debug(f"Camera '{camera_name}' is not in filter list '{CAMERAS}'. Ignoring event.")
+        # Every matching rule's recipients get the one email
+        recipients = list(dict.fromkeys(r for rule in matched for r in rule.recipients))
+        # The frame that qualified the event, for the end-to-end latency metric
+        event_time = payload['after'].get('frame_time') or payload['after'].get('start_time')
+        job = (event_id, camera_name, payload['after'].get('box'), recipients, event_time)
+
+        if self.tracker:
+            # Picks the message to alert on and calls alert_event with it
+            self.tracker.observe(payload.get('type'), payload['after'], job)
             return
 
-        # Check if the event label matches the filter
-        if event_label != EVENT_TYPE:
-            logging.debug(f"Event label '{event_label}' does not match filter '{EVENT_TYPE}'. Ignoring event.")
+        # Check if the event ID has already been processed
+        if not self.dedup.seen(event_id):
+            # Ensure email sending is allowed before handing the event to a worker
+            if not self.is_email_sending_allowed():
+                EVENTS_FILTERED.inc(reason='not_allowed')
+            elif not payload['after']['has_snapshot']:
+                EVENTS_FILTERED.inc(reason='no_snapshot')
+            else:
+                if self.config.media_prefetch_clips:
+                    # Now rather than on the worker, whose download may still be running when the event ends
+                    self.record_alerted(event_id)
+                self.enqueue_event(job)
+        else:
+            EVENTS_DEDUPED.inc()
+            logging.debug(f"Duplicate event ID {event_id} ignored. Dedup cache: {self.dedup.stats()}")
+
+    def alert_event(self, job, followup=False):
+        """Queue the event the tracker picked; a follow-up is the same event again with a better snapshot."""
+        event_id = job[0]
+        if not followup and self.dedup.seen(event_id):
+            EVENTS_DEDUPED.inc()
+            logging.debug(f"Duplicate event ID {event_id} ignored. Dedup cache: {self.dedup.stats()}")
+            return
+        if not self.is_email_sending_allowed():
+            EVENTS_FILTERED.inc(reason='not_allowed')
+            return
+        if self.config.media_prefetch_clips:
+            # Before the event's end message is handled, which may be what triggered this alert
+            self.record_alerted(event_id)
+        self.enqueue_event(job + (followup,))
+
+    def enqueue_event(self, job):
+        # Called from the MQTT network thread, so never block it unless asked to
+        if self.config.queue_overflow == 'block':
+            self.event_queue.put(job)
             return
 
-        # Check if the event ID is in the list of last 10 processed IDs
-        if event_id not in last_event_ids:
-            last_event_ids.append(event_id)
-            if len(last_event_ids) > 10:
-                last_event_ids.pop(0)  # Keep only the last 10 event IDs
-
-            # Ensure email sending is allowed before downloading the snapshot
-            if is_email_sending_allowed() and payload['after']['has_snapshot']:
-                snapshot_url = f"http://{FRIGATE_HOST}:{FRIGATE_PORT}/api/events/{event_id}/snapshot.jpg"
-                logging.debug(f"Downloading image from {snapshot_url}")
+        while True:
+            try:
+                self.event_queue.put_nowait(job)
+                logging.debug(f"Queued event ID {job[0]} (queue depth {self.event_queue.qsize()})")
+                return
+            except queue.Full:
+                if self.config.queue_overflow == 'drop_newest':
+                    EVENTS_DROPPED.inc()
+                    logging.warning(f"Event queue full, dropping event ID {job[0]}")
+                    return
                 try:
-                    response = requests.get(snapshot_url)
-                    response.raise_for_status()
-                    image = response.content
-                    logging.debug("Image downloaded successfully")
-                    send_email(event_id, camera_name, image)
-                except Exception as e:
-                    logging.error(f"Failed to download image. Error: {e}")
-        else:
-            logging.debug(f"Duplicate event ID {event_id} ignored.")
-
-def send_email(event_id, camera_name, image):
-    if not is_email_sending_allowed():
-        logging.info("Email sending is currently disabled or snoozed.")
-        return
-
-    subject = f"Frigate Event on Camera: {camera_name}"
-    body = f"Here is the snapshot for the event ID {event_id} from camera {camera_name}."
-    html = f"""
-    <html>
-        <body>
-            <p>{body}</p>
-            <p><a href="mailto:{EMAIL_ADDRESS}?subject=Send%20Clip&body=Please%20send%20the%20clip%20for%20the%20event%20ID%20{event_id}%20detected%20on%20camera%20{camera_name}.">Request Clip</a></p>
-        </body>
-    </html>
-    """
-
-    msg = MIMEMultipart("alternative")
-    msg['From'] = EMAIL_ADDRESS
-    msg['To'] = EMAIL_RECIPIENT
-    msg['Subject'] = subject
+                    dropped = self.event_queue.get_nowait()
+                    self.event_queue.task_done()
+                    EVENTS_DROPPED.inc()
+                    logging.warning(f"Event queue full, dropping oldest event ID {dropped[0]}")
+                except queue.Empty:
+                    pass
+
+    def prefetch_clip(self, event):
+        event_id = event['id']
+        with self._alerted_events_lock:
+            alerted = self._alerted_events.pop(event_id, None) is not None
+        if alerted and event.get('has_clip'):
+            logging.debug(f"Event {event_id} ended, prefetching its clip in {self.config.media_prefetch_delay:.0f} seconds")
+            self.media.prefetch_clip(event_id, self.config.media_prefetch_delay)
+
+    def record_alerted(self, event_id):
+        with self._alerted_events_lock:
+            self._alerted_events[event_id] = True
+            while len(self._alerted_events) > self.config.dedup_max_size:
+                self._alerted_events.popitem(last=False)
+
+    def forget_alerted(self, event_id):
+        """No email goes out for the event after all, so its clip is not prefetched."""
+        with self._alerted_events_lock:
+            self._alerted_events.pop(event_id, None)
+
+    def process_event(self, event_id, camera_name, box, recipients, event_time=None, followup=False):
+        # With a shared dedup store, the replica that claims the event sends it; done here, off the MQTT thread
+        if not followup:
+            claimed = self.dedup.claim(event_id)
+            if self.tracker:
+                # A follow-up only goes out from the replica that sent the first alert
+                self.tracker.claimed(event_id, claimed)
+            if not claimed:
+                self.forget_alerted(event_id)
+                EVENTS_DEDUPED.inc()
+                logging.debug(f"Event ID {event_id} is handled by another replica. Dedup cache: {self.dedup.stats()}")
+                return
+
+        logging.debug(f"Downloading snapshot for event ID {event_id}")
+        try:
+            with SNAPSHOT_SECONDS.time():
+                # A follow-up is sent because Frigate has a better snapshot than the cached one
+                snapshot = self.media.snapshot(event_id, self.snapshots.params(), refresh=followup)
+                logging.debug(f"Image downloaded successfully ({len(snapshot)} bytes)")
+                image = self.snapshots.prepare(snapshot, box)
+        except Exception as e:
+            EVENT_FAILURES.inc(stage='snapshot')
+            logging.error(f"Failed to download image. Error: {e}")
+            if not followup:
+                self.forget_alerted(event_id)
+            return
 
-    msg.attach(MIMEText(body, 'plain'))
-    msg.attach(MIMEText(html, 'html'))
+        if self.digest:
+            self.digest.add(event_id, camera_name, image, recipients, event_time)
+        else:
+            self.send_email(event_id, camera_name, image, recipients, event_time, followup)
+
+    def event_worker(self):
+        while True:
+            job = self.event_queue.get()
+            try:
+                self.process_event(*job)
+            except Exception as e:
+                logging.error(f"Failed to process event ID {job[0]}. Error: {e}")
+            finally:
+                self.event_queue.task_done()
+
+    def clip_request_link(self, event_id, camera_name):
+        # With CLIP_TOKEN_SECRET the subject carries a signed token, so the listener never has to read the body
+        secret = self.config.clip_token_secret
+        subject = request_subject(event_id, secret) if secret else "Send Clip"
+        return f"mailto:{self.config.email_address}?subject={quote(subject)}&body=Please%20send%20the%20clip%20for%20the%20event%20ID%20{event_id}%20detected%20on%20camera%20{camera_name}."
+
+    def send_digest_email(self, events, recipients):
+        # The schedule may have changed while the event was queued or its snapshot downloaded
+        if not self.is_email_sending_allowed():
+            return
 
-    # Attach image
-    try:
-        image_attachment = MIMEImage(image)
-        image_attachment.add_header('Content-Disposition', 'attachment; filename="snapshot.jpg"')
-        msg.attach(image_attachment)
-    except Exception as e:
-        logging.error(f"Failed to attach image. Error: {e}")
+        # Group the snapshots by camera, keeping the order the cameras first fired in
+        cameras = {}
+        for event in events:
+            cameras.setdefault(event['camera'], []).append(event)
+
+        subject = "Frigate Events: " + ", ".join(f"{len(items)} on {camera}" for camera, items in cameras.items())
+        text_lines = []
+        html_sections = []
+        images = []
+        for camera, items in cameras.items():
+            text_lines.append(f"Camera {camera}:")
+            html_sections.append(f"<h3>Camera {camera}</h3>")
+            for event in items:
+                event_id = event['event_id']
+                seen_at = time.strftime('%H:%M:%S', time.localtime(event['time']))
+                content_id = f"snapshot-{len(images)}"
+                text_lines.append(f"  {seen_at} event ID {event_id}")
+                html_sections.append(
+                    f"<p>{seen_at} event ID {event_id} "
+                    f"(<a href=\"{self.clip_request_link(event_id, camera)}\">Request Clip</a>)<br>"
+                    f"<img src=\"cid:{content_id}\" alt=\"{camera} {event_id}\" style=\"max-width: 100%;\"></p>")
+                images.append((content_id, event_id, event['image']))
+
+        body = "\n".join(text_lines)
+        html = f"""
+        <html>
+            <body>
+                {''.join(html_sections)}
+            </body>
+        </html>
+        """
+
+        msg = MIMEMultipart("related")
+        msg['From'] = self.config.email_address
+        msg['To'] = ', '.join(recipients)
+        msg['Subject'] = subject
+
+        alternative = MIMEMultipart("alternative")
+        alternative.attach(MIMEText(body, 'plain'))
+        alternative.attach(MIMEText(html, 'html'))
+        msg.attach(alternative)
+
+        for content_id, event_id, image in images:
+            try:
+                image_attachment = MIMEImage(image)
+                image_attachment.add_header('Content-ID', f"<{content_id}>")
+                image_attachment.add_header('Content-Disposition', 'inline', filename=f"{event_id}.jpg")
+                msg.attach(image_attachment)
+            except Exception as e:
+                logging.error(f"Failed to attach image for event ID {event_id}. Error: {e}")
+
+        try:
+            logging.debug(f"Queueing digest email with {len(events)} event(s)...")
+            event_times = [event['event_time'] for event in events if event.get('event_time')]
+            self.spool.enqueue(self.config.email_address, recipients, msg,
+                               event_time=min(event_times) if event_times else None)
+            EMAILS_QUEUED.inc(kind='digest')
+            logging.debug("Digest email queued for sending")
+        except Exception as e:
+            EVENT_FAILURES.inc(stage='spool')
+            logging.error(f"Failed to queue digest email. Error: {e}")
+
+    @timed(SEND_EMAIL_SECONDS)
+    def send_email(self, event_id, camera_name, image, recipients, event_time=None, followup=False):
+        # The schedule may have changed while the event was queued or its snapshot downloaded
+        if not self.is_email_sending_allowed():
+            return
 
-    try:
-        logging.debug("Attempting to send email...")
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_ADDRESS, EMAIL_RECIPIENT, text)
-        server.quit()
-        logging.debug("Email sent successfully!")
-    except Exception as e:
-        logging.error(f"Failed to send email. Error: {e}")
+        subject = f"Frigate Event on Camera: {camera_name}"
+        if followup:
+            subject += " (better snapshot)"
+        body = f"Here is the snapshot for the event ID {event_id} from camera {camera_name}."
+        html = f"""
+        <html>
+            <body>
+                <p>{body}</p>
+                <p><a href="{self.clip_request_link(event_id, camera_name)}">Request Clip</a></p>
+            </body>
+        </html>
+        """
+
+        msg = MIMEMultipart("alternative")
+        msg['From'] = self.config.email_address
+        msg['To'] = ', '.join(recipients)
+        msg['Subject'] = subject
+
+        msg.attach(MIMEText(body, 'plain'))
+        msg.attach(MIMEText(html, 'html'))
+
+        # Attach image
+        try:
+            image_attachment = MIMEImage(image)
+            image_attachment.add_header('Content-Disposition', 'attachment; filename="snapshot.jpg"')
+            msg.attach(image_attachment)
+        except Exception as e:
+            logging.error(f"Failed to attach image. Error: {e}")
+
+        try:
+            logging.debug("Queueing email...")
+            self.spool.enqueue(self.config.email_address, recipients, msg, event_time=event_time)
+            EMAILS_QUEUED.inc(kind='followup' if followup else 'event')
+            logging.debug("Email queued for sending")
+        except Exception as e:
+            EVENT_FAILURES.inc(stage='spool')
+            logging.error(f"Failed to queue email. Error: {e}")
 
 if __name__ == "__main__":
-    logging.debug(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-    client.on_message = on_message
+    config = NotifierConfig.from_env()
+    config.log()
+    notifier = Notifier(config)
+    start_http_server()
+
+    notifier.start()
+    notifier.smtp_pool.warm()
 
     try:
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        client = notifier.connect()
     except Exception as e:
         logging.error(f"Failed to connect to MQTT broker: {e}")
         exit(1)
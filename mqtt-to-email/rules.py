@@ -0,0 +1,107 @@
+import json
+import logging
+import threading
+
+from event_filter import EventFilter, needles
+
+WILDCARD = '*'
+
+
+class Rule(EventFilter):
+    """One row of the rule table: an EventFilter plus who gets the email."""
+
+    def __init__(self, name, recipients, cameras=None, labels=None, event_types=None, zones=None, min_score=0.0):
+        super().__init__(cameras or [], labels or [], event_types, zones, min_score)
+        self.name = name
+        self.recipients = tuple(recipients)
+
+    @classmethod
+    def from_dict(cls, data, default_recipients):
+        def as_list(value):
+            if value is None:
+                return []
+            values = [value] if isinstance(value, str) else list(value)
+            return [] if WILDCARD in values or 'ALL' in values else values
+
+        return cls(data.get('name', 'unnamed'), as_list(data.get('recipients')) or default_recipients,
+                   cameras=as_list(data.get('cameras', data.get('camera'))),
+                   labels=as_list(data.get('labels', data.get('label'))),
+                   event_types=as_list(data.get('event_types', data.get('type'))),
+                   zones=as_list(data.get('zones', data.get('zone'))),
+                   min_score=float(data.get('min_score', 0)))
+
+
+class RuleSet:
+    """Rules indexed by (camera, label), so a message costs one dict lookup however many rules there are.
+
+    Rules without a camera or label are stored under a wildcard key. The first
+    message for a camera/label pair merges the exact and wildcard entries once and
+    caches the result for the next messages.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._index = {}
+        for rule in self.rules:
+            for camera in rule.cameras or (WILDCARD,):
+                for label in rule.labels or (WILDCARD,):
+                    self._index.setdefault((camera, label), []).append(rule)
+        self._resolved = {}
+        self._resolved_lock = threading.Lock()
+
+        # Raw payloads only need decoding if they mention a camera and a label some rule is about
+        self._needle_groups = []
+        if self.rules:
+            for values in ([r.labels for r in self.rules], [r.cameras for r in self.rules]):
+                if all(v is not None for v in values):
+                    quoted = needles(set().union(*values))
+                    if quoted:
+                        self._needle_groups.append(quoted)
+
+    @classmethod
+    def load(cls, path, default_recipients):
+        with open(path) as f:
+            data = json.load(f)
+        return cls.from_data(data, default_recipients)
+
+    @classmethod
+    def from_data(cls, data, default_recipients):
+        rules = data.get('rules', []) if isinstance(data, dict) else data
+        return cls(Rule.from_dict(rule, default_recipients) for rule in rules)
+
+    def quick_reject(self, payload):
+        if not self.rules:
+            return True
+        for group in self._needle_groups:
+            if not any(needle in payload for needle in group):
+                return True
+        return False
+
+    def candidates(self, camera, label):
+        key = (camera, label)
+        rules = self._resolved.get(key)
+        if rules is None:
+            rules = []
+            for lookup in (key, (camera, WILDCARD), (WILDCARD, label), (WILDCARD, WILDCARD)):
+                rules.extend(rule for rule in self._index.get(lookup, ()) if rule not in rules)
+            rules = tuple(rules)
+            with self._resolved_lock:
+                self._resolved[key] = rules
+        return rules
+
+    def match(self, event):
+        """Rules the decoded event satisfies, logging why the others did not at DEBUG level."""
+        after = event['after']
+        matched = []
+        for rule in self.candidates(after['camera'], after['label']):
+            reason = rule.reject_reason(event)
+            if reason is None:
+                matched.append(rule)
+            elif logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"Rule '{rule.name}': {reason}")
+        return matched
+
+    def describe(self):
+        return [f"{rule.name}: cameras={sorted(rule.cameras) if rule.cameras else 'ALL'} "
+                f"labels={sorted(rule.labels) if rule.labels else 'ALL'} -> {', '.join(rule.recipients)}"
+                for rule in self.rules]
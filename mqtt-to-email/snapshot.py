@@ -0,0 +1,84 @@
+import io
+import logging
+import time
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for SNAPSHOT_PROCESSING=local
+    Image = None
+
+
+def crop_box(size, box, padding):
+    width, height = size
+    x1, y1, x2, y2 = box
+    pad_x = (x2 - x1) * padding
+    pad_y = (y2 - y1) * padding
+    return (max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y)),
+            min(width, int(x2 + pad_x)), min(height, int(y2 + pad_y)))
+
+
+def process_image(image, box=None, max_dimension=0, quality=0, crop=False, padding=0.25):
+    """Crop, downscale and re-encode JPEG bytes with Pillow. Returns the new bytes."""
+    with Image.open(io.BytesIO(image)) as picture:
+        # Without a crop, thumbnail() lets the JPEG decoder scale down while decoding, which is much cheaper
+        if crop and box:
+            picture = picture.crop(crop_box(picture.size, box, padding))
+        if max_dimension and max(picture.size) > max_dimension:
+            picture.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if picture.mode != 'RGB':
+            picture = picture.convert('RGB')
+        output = io.BytesIO()
+        picture.save(output, format='JPEG', quality=quality or 85, optimize=True)
+        return output.getvalue()
+
+
+class SnapshotProcessor:
+    """Crops, scales and re-encodes snapshots, either by asking Frigate (`frigate`) or with Pillow (`local`).
+
+    `max_dimension` and `jpeg_quality` of 0 keep Frigate's size and encoding; `crop`
+    cuts the snapshot down to the detected object plus `crop_padding` of its size.
+    """
+
+    def __init__(self, processing='frigate', max_dimension=0, jpeg_quality=0, crop=False, crop_padding=0.25):
+        if processing == 'local' and Image is None:
+            logging.warning("SNAPSHOT_PROCESSING=local needs Pillow, which is not installed; letting Frigate process snapshots")
+            processing = 'frigate'
+        self.processing = processing
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.crop = crop
+        self.crop_padding = crop_padding
+
+    def params(self):
+        """Query parameters asking Frigate to crop, scale and re-encode when it does the processing.
+
+        Frigate scales by height, so in frigate mode `max_dimension` limits the height.
+        """
+        params = {}
+        if self.processing != 'frigate':
+            return params
+        if self.crop:
+            params['crop'] = 1
+        if self.max_dimension:
+            params['height'] = self.max_dimension
+        if self.jpeg_quality:
+            params['quality'] = self.jpeg_quality
+        return params
+
+    def prepare(self, image, box=None):
+        """Apply the local pipeline, if enabled, and log the bytes saved and the encode cost."""
+        if self.processing != 'local' or not (self.max_dimension or self.jpeg_quality or self.crop):
+            return image
+        started = time.perf_counter()
+        try:
+            processed = process_image(image, box, self.max_dimension, self.jpeg_quality, self.crop, self.crop_padding)
+        except Exception as e:
+            logging.error(f"Failed to process snapshot, sending the original. Error: {e}")
+            return image
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if len(processed) >= len(image):
+            logging.debug(f"Processed snapshot is not smaller ({len(processed)} >= {len(image)} bytes), sending the original")
+            return image
+        logging.debug(f"Snapshot reduced from {len(image)} to {len(processed)} bytes "
+                      f"(saved {len(image) - len(processed)}) in {elapsed_ms:.1f} ms")
+        return processed
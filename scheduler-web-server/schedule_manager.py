@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from common.schedule import CompiledSchedule
+
+TRANSITION_JOB_ID = 'schedule-transition'
+
+
+class ScheduleManager:
+    """Keeps at most one job in `scheduler`: the next time the schedule turns email sending on or off.
+
+    When the job fires, `publish(allowed, until)` is called if the answer changed,
+    and the job is replaced by the one for the following transition. Editing the
+    schedule replaces the pending job instead of adding another. Without a time
+    zone the schedule is re-checked hourly (see CompiledSchedule), and those
+    wake-ups publish nothing unless the answer changed.
+    """
+
+    def __init__(self, scheduler, publish, schedule, timezone=None):
+        self.scheduler = scheduler
+        self.publish = publish
+        self.timezone = timezone
+        self.compiled = CompiledSchedule(schedule, timezone)
+        # Last answer published, None before the first
+        self.allowed = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._transition(force=True)
+
+    def update(self, schedule):
+        with self._lock:
+            self.compiled = CompiledSchedule(schedule, self.timezone)
+        # Consumers re-read the whole schedule on an edit, so tell them the current state as well
+        self._transition(force=True)
+
+    def _transition(self, force=False):
+        with self._lock:
+            now = time.time()
+            allowed = self.compiled.allowed(now)
+            until, _ = self.compiled.next_transition(now)
+            changed = force or allowed != self.allowed
+            self.allowed = allowed
+            self.scheduler.add_job(self._transition, 'date', run_date=datetime.fromtimestamp(until, timezone.utc),
+                                   id=TRANSITION_JOB_ID, replace_existing=True, misfire_grace_time=None)
+        logging.debug(f"Email sending {'allowed' if allowed else 'not allowed'} by the schedule until "
+                      f"{datetime.fromtimestamp(until).isoformat(timespec='seconds')}")
+        if changed:
+            self.publish(allowed, until)
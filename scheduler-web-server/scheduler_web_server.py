@@ -1,26 +1,54 @@
 import logging
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, Response, g, jsonify, request, render_template, redirect, url_for, flash
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime, timedelta
 import paho.mqtt.client as mqtt
 import os
 import json
+import tempfile
+import threading
 import time
+import uuid
+
+from common.metrics import REGISTRY, Counter, Gauge, Histogram
+from common.schedule import DAYS, load_timezone, to_minutes
+from schedule_manager import ScheduleManager
+from state_stream import StateBroadcaster
+from wsgi_server import Server
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
+# Started together with the MQTT connection by start_background(), not at import
 scheduler = BackgroundScheduler()
-scheduler.start()
 
 # MQTT client configuration from environment variables
 mqtt_broker = os.getenv('MQTT_BROKER', 'mqtt-broker')  # Default to 'mqtt-broker' if not set
 mqtt_port = int(os.getenv('MQTT_PORT', 1883))
 mqtt_topic = "scheduler/config"
 notification_topic = "scheduler/notifications"
+# Full state, retained, so a (re)starting mqtt-to-email is up to date as soon as it subscribes
+state_topic = "scheduler/state"
+STATE_VERSION = 1
+
+# Kept across restarts, so restarting the web server does not reset everyone to sending 24/7
+state_file = os.getenv('SCHEDULER_STATE_FILE', 'data/scheduler_state.json')
+
+# Time zone the schedule is written in; use the same value as for mqtt-to-email
+schedule_timezone = os.getenv('SCHEDULE_TIMEZONE')
+
+# Web server: threads for ordinary requests, plus one per open /api/v1/events stream
+web_port = int(os.getenv('WEB_PORT', 5000))
+web_threads = int(os.getenv('WEB_THREADS', 16))
+sse_max_clients = int(os.getenv('SSE_MAX_CLIENTS', 250))
+sse_keepalive = float(os.getenv('SSE_KEEPALIVE', 15))  # seconds between comments on an idle stream
 
 client = mqtt.Client()
 
+# Metrics, served by the /metrics route
+UPDATES_PUBLISHED = Counter('scheduler_updates_published_total', 'Updates published to the notification topic', ['event_type'])
+PUBLISH_FAILURES = Counter('scheduler_publish_failures_total', 'Updates that could not be published')
+REQUEST_SECONDS = Histogram('http_request_seconds', 'Time to handle a web request')
+Gauge('sse_clients', 'Open /api/v1/events streams', lambda: broadcaster.clients)
+
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logging.debug("Connected to MQTT broker successfully")
@@ -28,32 +56,45 @@ def on_connect(client, userdata, flags, rc):
         logging.error(f"Failed to connect to MQTT broker, return code {rc}")
 
 def on_disconnect(client, userdata, rc):
+    # The loop_start() thread reconnects with the delays set below
     logging.warning(f"Disconnected from MQTT broker with result code {rc}")
-    try:
-        client.reconnect()
-    except Exception as e:
-        logging.error(f"Exception while reconnecting: {e}")
 
 # Set up MQTT client callbacks
 client.on_connect = on_connect
 client.on_disconnect = on_disconnect
+client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+background_started = False
+background_lock = threading.Lock()
 
-try:
-    client.connect(mqtt_broker, mqtt_port, 60)
-except Exception as e:
-    logging.error(f"Failed to connect to MQTT broker: {e}")
-    exit(1)
+def start_background():
+    """Connect to the MQTT broker and start the scheduler, once.
 
-# Clear retained messages on the topic
-client.publish(notification_topic, payload=None, retain=True)
-logging.debug("Cleared retained messages on the notification topic")
+    Called on startup and again before each publish, so importing the module (or
+    serving it from another WSGI server) costs no connection until one is needed.
+    """
+    global background_started
+    if background_started:
+        return
+    with background_lock:
+        if background_started:
+            return
+        client.connect(mqtt_broker, mqtt_port, 60)
 
-# Start the MQTT client loop in a separate thread
-client.loop_start()
+        # Deltas are no longer retained; clear one left behind by an older version
+        client.publish(notification_topic, payload=None, retain=True)
+
+        # Start the MQTT client loop in a separate thread
+        client.loop_start()
+        scheduler.start()
+        background_started = True
+    # Publishes the current edge and with it the retained state, so only once the client is up.
+    # Outside background_lock, which is never held while waiting for state_lock.
+    schedule_manager.start()
 
 # Global state variables
 email_sending_enabled = True
-snooze_end_time = None  # Stores the end time of the snooze period
+snooze_end_time = None  # Unix time the snooze period ends
 schedule = {
     'monday': {'start_time': '00:00', 'end_time': '23:59'},
     'tuesday': {'start_time': '00:00', 'end_time': '23:59'},
@@ -64,6 +105,77 @@ schedule = {
     'sunday': {'start_time': '00:00', 'end_time': '23:59'}
 }
 
+# Last schedule_transition sent, so the state document carries the current edge as well
+schedule_edge = None
+
+# Sequence number of the last change published; the epoch changes when the state starts afresh,
+# so consumers do not take the new sequence numbers for stale ones
+state_seq = 0
+state_epoch = uuid.uuid4().hex
+# Guards all of the state above; request threads change it and publish the change as one step.
+# Reentrant, since a schedule edit publishes the new edge from within the edit.
+state_lock = threading.RLock()
+
+# Pushes every change to the /api/v1/events streams
+broadcaster = StateBroadcaster(sse_max_clients)
+
+def state_document():
+    return {
+        'version': STATE_VERSION,
+        'epoch': state_epoch,
+        'seq': state_seq,
+        'email_sending_enabled': email_sending_enabled,
+        'snooze_until': snooze_end_time,
+        'schedule': schedule,
+        'timezone': schedule_timezone,
+        'schedule_edge': schedule_edge
+    }
+
+def load_state():
+    global email_sending_enabled, snooze_end_time, schedule_edge, state_seq, state_epoch, saved_position
+    try:
+        with open(state_file) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to load scheduler state from {state_file}, starting with the defaults. Error: {e}")
+        return
+    email_sending_enabled = saved.get('email_sending_enabled', True)
+    snooze_end_time = saved.get('snooze_until')
+    schedule.update(saved.get('schedule') or {})
+    schedule_edge = saved.get('schedule_edge')
+    state_seq = saved.get('seq', 0)
+    state_epoch = saved.get('epoch') or state_epoch
+    saved_position = (state_epoch, state_seq)
+
+# (epoch, seq) of the document in state_file, so an older one never replaces it
+saved_position = None
+
+def save_state(document):
+    """Write `document` to state_file atomically; called with state_lock held."""
+    global saved_position
+    position = (document['epoch'], document['seq'])
+    if saved_position and saved_position[0] == position[0] and position[1] < saved_position[1]:
+        return
+    state_dir = os.path.dirname(state_file) or '.'
+    tmp_path = None
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        # A temporary file of its own, so concurrent writers never share one
+        fd, tmp_path = tempfile.mkstemp(prefix='.scheduler_state.', suffix='.tmp', dir=state_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(document, f)
+        os.replace(tmp_path, state_file)
+        saved_position = position
+    except OSError as e:
+        logging.error(f"Failed to save scheduler state to {state_file}. Error: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+load_state()
+broadcaster.publish(state_document(), f"{state_epoch}-{state_seq}")
+
 day_mapping = {
     'mon': 'monday',
     'tue': 'tuesday',
@@ -74,56 +186,158 @@ day_mapping = {
     'sun': 'sunday'
 }
 
-def send_email():
-    # Your email sending logic here
-    pass
-
 def publish_update(event_type, details):
-    message = {
-        'event_type': event_type,
-        'details': details
-    }
-    try:
-        result = client.publish(notification_topic, json.dumps(message), retain=True)
-        if result.rc != mqtt.MQTT_ERR_SUCCESS:
-            logging.error(f"Failed to publish message: {result}")
-        else:
-            logging.debug(f"Published {event_type} message with details: {details}")
-    except Exception as e:
-        logging.error(f"Exception while publishing message: {e}")
+    """Publish a change as a sequenced delta, then the full state document that includes it.
 
-@app.route('/set_schedule_gui', methods=['POST'])
-def set_schedule_gui():
-    global schedule
-    days = request.form.getlist('days')
-    try:
-        if not days:
-            raise ValueError("At least one day must be selected.")
+    Called with state_lock held by whoever made the change, so the document is the
+    state right after it and sequence numbers go out in the order they are taken.
+    """
+    global state_seq
+    with state_lock:
+        state_seq += 1
+        message = {
+            'event_type': event_type,
+            'details': details,
+            'epoch': state_epoch,
+            'seq': state_seq
+        }
+        document = state_document()
+        # Event stream clients see every change, including one the broker is not there for
+        broadcaster.publish(document, f"{state_epoch}-{state_seq}")
+        try:
+            start_background()
+            result = client.publish(notification_topic, json.dumps(message))
+            client.publish(state_topic, json.dumps(document), qos=1, retain=True)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                PUBLISH_FAILURES.inc()
+                logging.error(f"Failed to publish message: {result}")
+            else:
+                UPDATES_PUBLISHED.inc(event_type=event_type)
+                logging.debug(f"Published {event_type} message with details: {details}")
+        except Exception as e:
+            PUBLISH_FAILURES.inc()
+            logging.error(f"Exception while publishing message: {e}")
+        # Under the lock, so the file always ends up with the latest document
+        save_state(document)
 
-        new_schedule = schedule.copy()  # Copy the existing schedule
+def publish_transition(allowed, until):
+    global schedule_edge
+    with state_lock:
+        # Compact edge event, so consumers need not evaluate the schedule on every Frigate event
+        schedule_edge = {'allowed': allowed, 'until': int(until)}
+        publish_update("schedule_transition", {
+            'allowed': allowed,
+            'until': int(until)
+        })
 
-        for day in days:
-            start_time = request.form.get(f'{day}_start_time')
-            end_time = request.form.get(f'{day}_end_time')
+# Holds the one pending job: the next time the schedule turns email sending on or off
+schedule_manager = ScheduleManager(scheduler, publish_transition, schedule, schedule_timezone)
+
+def check_time(value):
+    try:
+        hours, minutes = value.split(':')
+        valid = len(hours) == 2 and len(minutes) == 2 and 0 <= int(hours) < 24 and 0 <= int(minutes) < 60
+    except (AttributeError, ValueError):
+        valid = False
+    if not valid:
+        raise ValueError(f"Invalid time '{value}', expected HH:MM.")
+    return to_minutes(value)
 
-            if not start_time or not end_time:
-                raise ValueError("Start time and end time must be provided for each selected day.")
+def check_windows(times):
+    """Validate one day's times: a window {'start_time': 'HH:MM', 'end_time': 'HH:MM'} or a list of them.
 
-            start_hour, start_minute = start_time.split(':')
-            end_hour, end_minute = end_time.split(':')
+    Returns them with only those keys, a list staying a list.
+    """
+    windows = times if isinstance(times, list) else [times]
+    for window in windows:
+        if not isinstance(window, dict) or not window.get('start_time') or not window.get('end_time'):
+            raise ValueError("Start time and end time must be provided for each selected day.")
+        check_time(window['start_time'])
+        check_time(window['end_time'])
+    windows = [{'start_time': window['start_time'], 'end_time': window['end_time']} for window in windows]
+    return windows if isinstance(times, list) else windows[0]
 
-            # Add job to the scheduler
-            scheduler.add_job(send_email, CronTrigger(day_of_week=day, hour=start_hour, minute=start_minute))
+def set_schedule(changes):
+    """Replace the times of the days in `changes`, each one window or a list of them (an empty list sends nothing that day).
 
-            # Save the schedule for the day with the full day name
-            full_day_name = day_mapping[day]
-            new_schedule[full_day_name] = {'start_time': start_time, 'end_time': end_time}
+    e.g. {'monday': {'start_time': 'HH:MM', 'end_time': 'HH:MM'}, 'tuesday': [{...}, {...}]}.
+    Everything is checked before anything changes; raises ValueError on a bad day or time.
+    """
+    global schedule, schedule_edge
+    if not isinstance(changes, dict) or not changes:
+        raise ValueError("At least one day must be given.")
+    checked = {}
+    for day, times in changes.items():
+        if day not in DAYS:
+            raise ValueError(f"Unknown day '{day}'.")
+        checked[day] = check_windows(times)
+    with state_lock:
+        # The edge follows from the schedule manager
+        schedule = dict(schedule, **checked)
+        schedule_edge = None
+        details = {'schedule': schedule}
+        if schedule_timezone:
+            details['timezone'] = schedule_timezone
+        publish_update("schedule_set", details)
+        # Replaces the pending transition job and publishes the state under the new schedule
+        schedule_manager.update(schedule)
 
-        # Update the global schedule and publish the update
-        schedule = new_schedule
-        publish_update("schedule_set", {
-            'schedule': schedule
+def set_email_sending(enabled=None):
+    """Turn email sending on or off; None toggles it. Returns the new setting."""
+    global email_sending_enabled
+    with state_lock:
+        email_sending_enabled = (not email_sending_enabled) if enabled is None else bool(enabled)
+        publish_update("email_sending_toggled", {
+            'enabled': email_sending_enabled
+        })
+        return email_sending_enabled
+
+def snooze(minutes):
+    """Snooze email sending for `minutes`; 0 clears the snooze."""
+    global snooze_end_time
+    with state_lock:
+        snooze_end_time = time.time() + minutes * 60 if minutes > 0 else None
+        # 'until' is absolute, so a delivery delay or redelivery does not stretch the snooze
+        publish_update("snooze_set", {
+            'cooldown_minutes': minutes,
+            'until': snooze_end_time
         })
+
+def remaining_snooze_time():
+    # Seconds, or None when not snoozed; the snooze simply runs out, nothing is cleared
+    remaining = int(snooze_end_time - time.time()) if snooze_end_time else 0
+    return remaining if remaining > 0 else None
+
+def api_state():
+    with state_lock:
+        state = state_document()
+        state['snooze_remaining'] = remaining_snooze_time()
+    return state
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/set_schedule_gui', methods=['POST'])
+def set_schedule_gui():
+    days = request.form.getlist('days')
+    try:
+        if not days:
+            raise ValueError("At least one day must be selected.")
+        # Save the schedule for each day with the full day name
+        set_schedule({day_mapping[day]: {'start_time': request.form.get(f'{day}_start_time'),
+                                         'end_time': request.form.get(f'{day}_end_time')} for day in days})
         flash('Schedule set successfully!', 'success')
     except Exception as e:
         app.logger.error(f"Exception on /set_schedule_gui: {str(e)}")
@@ -133,57 +347,140 @@ def set_schedule_gui():
 
 @app.route('/toggle_email_sending_gui', methods=['POST'])
 def toggle_email_sending_gui():
-    global email_sending_enabled
-    email_sending_enabled = not email_sending_enabled
-    publish_update("email_sending_toggled", {
-        'enabled': email_sending_enabled
-    })
-    flash(f"Email sending {'enabled' if email_sending_enabled else 'disabled'}.", 'success')
+    enabled = set_email_sending()
+    flash(f"Email sending {'enabled' if enabled else 'disabled'}.", 'success')
     return redirect(url_for('index'))
 
 @app.route('/snooze_gui', methods=['POST'])
 def snooze_gui():
-    global snooze_end_time
     snooze_duration = int(request.form.get('cooldown_minutes', 60))
-    snooze_end_time = datetime.utcnow() + timedelta(minutes=snooze_duration)
     logging.debug(f"Publishing snooze_set event with cooldown_minutes: {snooze_duration}")
-    publish_update("snooze_set", {
-        'cooldown_minutes': snooze_duration
-    })
+    snooze(snooze_duration)
     flash(f"Email sending snoozed for {snooze_duration} minutes.", 'success')
     return redirect(url_for('index'))
 
 @app.route('/clear_snooze', methods=['POST'])
 def clear_snooze():
-    global snooze_end_time
-    snooze_end_time = None
-    publish_update("snooze_set", {
-        'cooldown_minutes': 0
-    })
+    snooze(0)
     flash('Snooze cleared, email sending enabled immediately.', 'success')
     return redirect(url_for('index'))
 
+@app.route('/reload_rules', methods=['POST'])
+def reload_rules():
+    publish_update("rules_reload", {})
+    flash('Asked mqtt-to-email to reload its rules.', 'success')
+    return redirect(url_for('index'))
+
 @app.route('/')
 def index():
-    global snooze_end_time, schedule
-    # Calculate remaining snooze time in seconds
-    remaining_snooze_time = None
-    if snooze_end_time:
-        remaining_snooze_time = int((snooze_end_time - datetime.utcnow()).total_seconds())  # Convert to seconds
-        if remaining_snooze_time <= 0:
-            remaining_snooze_time = None
-            snooze_end_time = None
-
-    # Define the current schedule
-    current_schedule = {
-        'days': schedule,
-        'email_sending_enabled': email_sending_enabled,
-        'remaining_snooze_time': remaining_snooze_time
-    }
+    with state_lock:
+        # Define the current schedule
+        current_schedule = {
+            # Every day as a list of windows; the form edits the first
+            'days': {day: times if isinstance(times, list) else [times] for day, times in schedule.items()},
+            'email_sending_enabled': email_sending_enabled,
+            'remaining_snooze_time': remaining_snooze_time()
+        }
     return render_template('index.html', schedule=current_schedule)
 
+# JSON API. Every change answers with the state after it, the same document GET /api/v1/state returns
+# (plus snooze_remaining) and /api/v1/events pushes.
+
+def api_error(message, status=400):
+    return jsonify({'error': message}), status
+
+def json_body():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object.")
+    return body
+
+@app.route('/api/v1/state')
+def api_get_state():
+    return jsonify(api_state())
+
+@app.route('/api/v1/schedule', methods=['GET', 'PUT'])
+def api_schedule():
+    if request.method == 'PUT':
+        try:
+            # Only the days given change
+            set_schedule(json_body().get('schedule'))
+        except ValueError as e:
+            return api_error(f"Failed to set schedule: {e}")
+    with state_lock:
+        return jsonify({'schedule': schedule, 'timezone': schedule_timezone})
+
+@app.route('/api/v1/email_sending', methods=['PUT'])
+def api_email_sending():
+    try:
+        enabled = json_body().get('enabled')
+        if not isinstance(enabled, bool):
+            raise ValueError("'enabled' must be true or false.")
+    except ValueError as e:
+        return api_error(str(e))
+    set_email_sending(enabled)
+    return jsonify(api_state())
+
+@app.route('/api/v1/email_sending/toggle', methods=['POST'])
+def api_toggle_email_sending():
+    set_email_sending()
+    return jsonify(api_state())
+
+@app.route('/api/v1/snooze', methods=['POST', 'DELETE'])
+def api_snooze():
+    if request.method == 'DELETE':
+        snooze(0)
+        return jsonify(api_state())
+    try:
+        minutes = json_body().get('minutes', 60)
+        if isinstance(minutes, bool) or not isinstance(minutes, (int, float)) or minutes <= 0:
+            raise ValueError("'minutes' must be a positive number.")
+    except ValueError as e:
+        return api_error(str(e))
+    snooze(minutes)
+    return jsonify(api_state())
+
+@app.route('/api/v1/events')
+def api_events():
+    """Server-sent events: the current state straight away, then the state after every change."""
+    if not broadcaster.subscribe():
+        response = jsonify({'error': "Too many event stream clients, try again later."})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    version = broadcaster.start_version(request.headers.get('Last-Event-ID'))
+
+    def stream(version):
+        # Reconnect after 5 seconds if the connection drops
+        yield "retry: 5000\n\n"
+        while True:
+            version, event = broadcaster.wait(version, sse_keepalive)
+            # A comment on an idle stream keeps proxies from closing it and finds clients that went away
+            yield event or ": keepalive\n\n"
+
+    response = Response(stream(version), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Runs whether or not the stream got started
+    response.call_on_close(broadcaster.unsubscribe)
+    return response
+
 if __name__ == '__main__':
     # Add logging configuration
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    app.run(host='0.0.0.0', port=5000)
+    try:
+        load_timezone(schedule_timezone)
+    except ValueError as e:
+        # Transitions would otherwise follow the container's clock, usually UTC
+        logging.error(f"Invalid SCHEDULE_TIMEZONE. Error: {e}")
+        exit(1)
+
+    try:
+        start_background()
+    except Exception as e:
+        logging.error(f"Failed to connect to MQTT broker: {e}")
+        exit(1)
+
+    # Multi-threaded, so the event streams and the forms are served at the same time
+    Server(app, port=web_port, threads=web_threads, max_streams=sse_max_clients).run()
@@ -0,0 +1,56 @@
+import json
+import threading
+
+
+def format_event(document, event_id):
+    return f"id: {event_id}\nevent: state\ndata: {json.dumps(document)}\n\n"
+
+
+class StateBroadcaster:
+    """Hands the latest state document to every server-sent events client.
+
+    Each change is formatted once rather than once per client, and a client that
+    falls behind skips straight to the latest state instead of queueing the ones in
+    between. At most `max_clients` streams are open at a time.
+    """
+
+    def __init__(self, max_clients=250):
+        self.max_clients = max_clients
+        self.clients = 0
+        self._cond = threading.Condition()
+        self._version = 0
+        self._event = None
+        self._event_id = None
+
+    def publish(self, document, event_id):
+        event = format_event(document, event_id)
+        with self._cond:
+            self._version += 1
+            self._event = event
+            self._event_id = event_id
+            self._cond.notify_all()
+
+    def subscribe(self):
+        """Count a new client in; False when there is no room for it."""
+        with self._cond:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self.clients -= 1
+
+    def start_version(self, last_event_id=None):
+        """Where a client starts: after the current state if it already has it (EventSource's Last-Event-ID)."""
+        with self._cond:
+            return self._version if last_event_id and last_event_id == self._event_id else None
+
+    def wait(self, version, timeout):
+        """The first event after `version`, or (version, None) if none comes within `timeout` seconds."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._event is not None and self._version != version, timeout)
+            if self._event is None or self._version == version:
+                return version, None
+            return self._version, self._event
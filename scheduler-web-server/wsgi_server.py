@@ -0,0 +1,52 @@
+import logging
+import socketserver
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+try:
+    import waitress
+except ImportError:  # optional; without it every connection gets a thread of the standard library server
+    waitress = None
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # Room for a burst of event stream clients reconnecting at once
+    request_queue_size = 128
+
+
+class _LoggingHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+
+class Server:
+    """Multi-threaded WSGI server: waitress when it is installed, the standard library's otherwise.
+
+    Every open event stream holds a thread for as long as it is open, so waitress
+    gets `threads` for ordinary requests on top of `max_streams` for the streams.
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000, threads=16, max_streams=250):
+        if waitress is not None:
+            self.name = 'waitress'
+            self._server = waitress.create_server(app, host=host, port=port, threads=threads + max_streams,
+                                                  connection_limit=threads + max_streams + 100)
+            self.port = self._server.effective_port
+        else:
+            self.name = 'wsgiref'
+            self._server = make_server(host, port, app, _ThreadingWSGIServer, _LoggingHandler)
+            self.port = self._server.server_port
+
+    def run(self):
+        logging.info(f"Serving on port {self.port} with {self.name}")
+        if waitress is not None:
+            self._server.run()
+        else:
+            self._server.serve_forever()
+
+    def close(self):
+        if waitress is not None:
+            self._server.close()
+        else:
+            self._server.shutdown()
+            self._server.server_close()